@@ -9,15 +9,53 @@ __version__   = "1.0"
 
 import os
 import sys
+import time
+import shutil
+import signal
 
 ESCAPE = '\x1b['
 
 def esc(code, *args):
     return ESCAPE + ";".join([str(a) for a in args]) + code
 
+_size = None
+_resized = False
+_watching = False
+_prevHandler = None
+
 def terminal_size():
-    rows, cols = os.popen('stty size', 'r').read().split()
-    return [int(rows), int(cols)]
+    """Returns [rows, cols] for the current terminal. The first call installs a SIGWINCH
+handler (see watchResize); the size is then cached until the terminal is resized. If the
+handler cannot be installed, the size is read again on every call."""
+    global _size
+    if _size is None:
+        cols, rows = shutil.get_terminal_size()
+        if not (_watching or watchResize()):
+            return [rows, cols]
+        _size = [rows, cols]
+    return _size
+
+def _onResize(signum, frame):
+    global _size, _resized
+    _size = None
+    _resized = True
+    if callable(_prevHandler):
+        _prevHandler(signum, frame)
+
+def watchResize():
+    """Install a SIGWINCH handler that invalidates the cached terminal size, chaining to any
+previously installed handler. Returns False on platforms without SIGWINCH, or when not
+called from the main thread."""
+    global _watching, _prevHandler
+    if _watching:
+        return True
+    if hasattr(signal, "SIGWINCH"):
+        try:
+            _prevHandler = signal.signal(signal.SIGWINCH, _onResize)
+            _watching = True
+        except ValueError:
+            pass
+    return _watching
 
 # Cursor controls
 
@@ -93,3 +131,133 @@ def saveScreen():
 
 def restoreScreen():
     return esc("l", "?47")
+
+# Screen buffer
+
+def sgr(*args):
+    """Returns the Select Graphic Rendition sequence for the given attributes (eg 1, 31 for bold red)."""
+    return esc("m", *args)
+
+class Screen(object):
+    """A double-buffered terminal screen. Callers draw into the buffer with put() and
+call render(), which compares the buffer with the previously displayed frame and
+writes only the cells that changed, with minimal cursor movement, in a single write.
+Renders are skipped if they come less than 1/fps seconds after the previous one.
+
+Example:
+  S = Screen()
+  S.start()
+  S.put(0, 0, "Progress: ")
+  S.put(0, 10, "{}%".format(pct), "1;32")
+  S.render()
+  ...
+  S.stop()
+"""
+    stream = None
+    rows = 0
+    cols = 0
+    fps = 20
+    frame = None                # Cells currently displayed
+    buffer = None               # Cells being drawn
+    lastRender = 0
+    blank = (" ", None)
+
+    def __init__(self, stream=sys.stdout, fps=20):
+        self.stream = stream
+        self.fps = fps
+        self.resize()
+
+    def resize(self):
+        """Read the terminal size and reset both buffers. The next render redraws the whole screen."""
+        global _resized
+        _resized = False
+        (self.rows, self.cols) = terminal_size()
+        self.buffer = [ [self.blank] * self.cols for r in range(self.rows) ]
+        self.frame = None
+
+    def start(self):
+        """Take over the terminal: save the screen, hide the cursor and start watching for resizes."""
+        watchResize()
+        self.stream.write(saveScreen() + cursorOff() + clearScreen())
+        self.stream.flush()
+
+    def stop(self):
+        """Restore the terminal to the state it was in before start()."""
+        self.stream.write(sgr(0) + cursorOn() + restoreScreen())
+        self.stream.flush()
+
+    def clear(self):
+        """Blank the drawing buffer."""
+        for row in self.buffer:
+            row[:] = [self.blank] * self.cols
+
+    def put(self, row, col, text, attrs=None):
+        """Write `text' into the buffer at (row, col) (0-based), using the SGR attributes `attrs'
+(eg "1;31"). Text falling outside the screen is clipped."""
+        if row < 0 or row >= self.rows:
+            return
+        line = self.buffer[row]
+        for c in text:
+            if col >= self.cols:
+                break
+            if col >= 0:
+                line[col] = (c, attrs)
+            col += 1
+
+    def _diff(self):
+        """Returns the escape sequences and text needed to turn the current frame into the buffer."""
+        out = []
+        curRow = curCol = None
+        curAttrs = None          # Every frame ends with attributes reset
+        old = self.frame
+        if old is None:
+            out.append(sgr(0) + clearScreen())
+            old = [ [self.blank] * self.cols for r in range(self.rows) ]
+        for r in range(self.rows):
+            new = self.buffer[r]
+            prev = old[r]
+            for c in range(self.cols):
+                cell = new[c]
+                if prev[c] == cell:
+                    continue
+                if r == curRow and c == curCol:
+                    pass
+                elif r == curRow and curCol < c <= curCol + 4 and all([ a[1] == curAttrs for a in new[curCol:c] ]):
+                    # Rewriting a few unchanged cells is shorter than moving the cursor
+                    out.append("".join([ a[0] for a in new[curCol:c] ]))
+                elif r == curRow and c > curCol:
+                    out.append(esc("C", c - curCol))
+                else:
+                    out.append(goto(r + 1, c + 1))
+                if cell[1] != curAttrs:
+                    if curAttrs:
+                        out.append(sgr(0))
+                    if cell[1]:
+                        out.append(sgr(cell[1]))
+                    curAttrs = cell[1]
+                out.append(cell[0])
+                curRow = r
+                curCol = c + 1
+        if curAttrs:
+            out.append(sgr(0))
+        return "".join(out)
+
+    def render(self, force=False):
+        """Display the buffer, writing only what changed since the last frame. Returns False
+if the render was skipped because of the frame rate limit (unless `force' is True)."""
+        now = time.time()
+        if not force and now - self.lastRender < 1.0 / self.fps:
+            return False
+        if _resized:
+            old = self.buffer
+            self.resize()
+            for r in range(min(len(old), self.rows)):
+                n = min(len(old[r]), self.cols)
+                self.buffer[r][:n] = old[r][:n]
+        data = self._diff()
+        if data:
+            self.stream.write(data)
+            self.stream.flush()
+        self.frame = [ list(row) for row in self.buffer ]
+        self.lastRender = now
+        return True
@@ -6,9 +6,22 @@ __author__ = "A. Riva, ICBR Bioinformatics Core"
 import os
 import sys
 import json
+import time
+import atexit
+import functools
+import hashlib
+import threading
 import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from BIutils.BIdb import SQLiteDatabase, DBTable
+from BIutils.BImisc import decodeUnits
 
-COMMANDS = ["list", "meta", "info", "initdir", "all", "api", "nreads", "report"]
+COMMANDS = ["list", "meta", "info", "initdir", "all", "sync", "api", "nreads", "allreads", "download", "report"]
+
+# Fields requested from `bs run list' by the sync command
+SYNC_FIELDS = ["Id", "ExperimentName", "DateModified"]
 
 def toList(s):
     """If s is not a list, return [s]."""
@@ -17,10 +30,324 @@ def toList(s):
     else:
         return [s]
 
+def spanLength(spans):
+    """Returns the total time covered by the (start, end) intervals in `spans', counting overlaps once."""
+    total = 0.0
+    last = None
+    for (start, end) in sorted(spans):
+        if last is None or start > last:
+            total += end - start
+            last = end
+        elif end > last:
+            total += end - last
+            last = end
+    return total
+
+class Tracer(object):
+    """Collects timing information on bs calls and on the BSClient methods that use them. Each
+event is written as a JSON line to `stream'; summary() prints totals for each event type.
+While a traced method runs, the intervals spent waiting for bs calls or file transfers
+(including those made by worker threads started with propagate()) are collected, so that
+its own time can be computed."""
+    stream = None
+    stats = {}                  # event name -> [count, wall, spawn, bytes, parse, wait]
+    _lock = None
+    _local = None
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stack(self):
+        """The wait-interval lists of the traced methods active in the current thread (outermost first)."""
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def propagate(self, func):
+        """Returns a version of `func' that, when run in another thread, attributes its waits to
+the traced methods active in the current thread."""
+        parents = list(self.stack())
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            saved = self.stack()
+            self._local.stack = list(parents)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = saved
+        return wrapper
+
+    def record(self, kind, name, wall, spawn=0.0, nbytes=0, parse=0.0, bs=0.0):
+        """Record an event. Events of kind bs and http are waits: their interval is added to all active traced methods."""
+        key = kind + ":" + name
+        now = time.time()
+        with self._lock:
+            if kind in ["bs", "http"]:
+                for spans in self.stack():
+                    spans.append((now - wall, now))
+            if key not in self.stats:
+                self.stats[key] = [0, 0.0, 0.0, 0, 0.0, 0.0]
+            st = self.stats[key]
+            st[0] += 1
+            st[1] += wall
+            st[2] += spawn
+            st[3] += nbytes
+            st[4] += parse
+            st[5] += bs
+            self.stream.write(json.dumps({"time": now, "type": kind, "name": name, "wall": round(wall, 6),
+                                          "spawn": round(spawn, 6), "bytes": nbytes, "parse": round(parse, 6),
+                                          "bs": round(bs, 6)}) + "\n")
+            self.stream.flush()
+
+    def summary(self, out=sys.stderr):
+        """Write a table with totals for each event type, sorted by decreasing wall time. For
+methods, the Own column is the time not spent waiting for bs calls or file transfers."""
+        out.write("{:40} {:>6} {:>10} {:>10} {:>10} {:>10} {:>12}\n".format("Event", "Calls", "Wall", "Spawn", "Parse", "Own", "Bytes"))
+        for key in sorted(self.stats.keys(), key=lambda k: -self.stats[k][1]):
+            (n, wall, spawn, nbytes, parse, bs) = self.stats[key]
+            own = wall - bs if key.startswith("method:") else 0.0
+            out.write("{:40} {:6} {:10.3f} {:10.3f} {:10.3f} {:10.3f} {:12}\n".format(key, n, wall, spawn, parse, own, nbytes))
+
+def traced(method):
+    """Decorator for BSClient methods: record their wall time in the client's tracer, if any."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.tracer:
+            return method(self, *args, **kwargs)
+        start = time.time()
+        spans = []
+        stack = self.tracer.stack()
+        stack.append(spans)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stack.pop()
+            with self.tracer._lock:
+                waited = spanLength(spans)
+            self.tracer.record("method", method.__name__, time.time() - start, bs=waited)
+    return wrapper
+
+class FileDownloader(object):
+    """Download files over HTTP(S) using a pool of threads. Partial files (saved with a .part
+extension) are resumed with Range requests, completed files are verified against their expected
+size and MD5 (when known), and the total bandwidth used by all threads can be capped."""
+    nthreads = 4
+    bwlimit = None              # Bytes per second, shared by all threads
+    chunksize = 1048576
+    retries = 3
+    retryDelay = 1.0            # Seconds before the first retry, doubled after each one
+    headers = {}
+    tracer = None               # If set, each transfer is recorded as an http event
+    _lock = None
+    _avail = 0                  # Time at which the bandwidth budget is next available
+
+    def __init__(self, nthreads=4, bwlimit=None, headers={}, tracer=None):
+        self.nthreads = nthreads
+        self.bwlimit = bwlimit
+        self.headers = headers
+        self.tracer = tracer
+        self._lock = threading.Lock()
+        self._avail = 0
+
+    def throttle(self, nbytes):
+        """Sleep as long as needed to keep the overall transfer rate below bwlimit."""
+        if not self.bwlimit:
+            return
+        with self._lock:
+            now = time.time()
+            self._avail = max(self._avail, now) + 1.0 * nbytes / self.bwlimit
+            delay = self._avail - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def verify(self, filename, size=None, md5=None):
+        """Returns None if `filename' has the expected `size' and `md5', or an error message."""
+        fsize = os.path.getsize(filename)
+        if size is not None and fsize != size:
+            return "size mismatch ({} bytes, expected {})".format(fsize, size)
+        if md5:
+            h = hashlib.md5()
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(self.chunksize), b""):
+                    h.update(block)
+            if h.hexdigest() != md5.lower():
+                return "MD5 mismatch"
+        return None
+
+    def fetch(self, url, partfile):
+        """Append the contents of `url' to `partfile', resuming from its current size. Returns the number
+of bytes transferred. A 416 (range not satisfiable) response to a resume means that `partfile'
+is already complete, so nothing is transferred."""
+        if self.tracer:
+            start = time.time()
+            nread = 0
+            try:
+                nread = self._fetch(url, partfile)
+            finally:
+                self.tracer.record("http", "download", time.time() - start, nbytes=nread)
+            return nread
+        return self._fetch(url, partfile)
+
+    def _fetch(self, url, partfile):
+        offset = os.path.getsize(partfile) if os.path.isfile(partfile) else 0
+        req = urllib.request.Request(url, headers=self.headers)
+        if offset:
+            req.add_header("Range", "bytes={}-".format(offset))
+        nread = 0
+        try:
+            resp = urllib.request.urlopen(req)
+        except urllib.error.HTTPError as e:
+            if offset and e.code == 416:
+                return 0
+            raise
+        with resp:
+            mode = "ab" if offset and resp.status == 206 else "wb" # Server may ignore Range
+            with open(partfile, mode) as out:
+                while True:
+                    block = resp.read(self.chunksize)
+                    if not block:
+                        break
+                    out.write(block)
+                    nread += len(block)
+                    self.throttle(len(block))
+        return nread
+
+    def transient(self, e):
+        """Returns True if the download error `e' may go away by retrying. HTTP errors are
+transient only for server errors (5xx), timeouts (408) and rate limiting (429)."""
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code >= 500 or e.code in [408, 429]
+        return True
+
+    def download(self, url, dest, size=None, md5=None):
+        """Download `url' to `dest'. Returns the number of bytes transferred (0 if `dest' was already complete).
+At most `retries' attempts are made; after a transient error the next attempt is made after
+waiting retryDelay seconds (doubled each time), other errors are raised immediately."""
+        if os.path.isfile(dest) and self.verify(dest, size=size) is None:
+            return 0
+        partfile = dest + ".part"
+        nread = 0
+        error = "no download attempted"
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(self.retryDelay * 2**(attempt - 1))
+            try:
+                # A part file may be complete if we were interrupted before renaming it
+                if not (size is not None and os.path.isfile(partfile) and os.path.getsize(partfile) >= size):
+                    nread += self.fetch(url, partfile)
+            except (IOError, OSError) as e:
+                if attempt == self.retries - 1 or not self.transient(e):
+                    raise
+                error = str(e)
+                continue
+            error = self.verify(partfile, size=size, md5=md5)
+            if error is None:
+                os.rename(partfile, dest)
+                return nread
+            os.remove(partfile)     # Corrupted, start over
+        raise IOError("{}: {}".format(dest, error))
+
+    def downloadAll(self, jobs, progress=None):
+        """Download all `jobs', each of which is a tuple (url, dest, size, md5). If supplied,
+`progress' is called as progress(dest, ndone, ntotal, error) after each file. Returns a
+tuple (nbytes, failed) where failed maps the destination of each failed job to its error message."""
+        failed = {}
+        nbytes = 0
+        ndone = 0
+        with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+            download = self.tracer.propagate(self.download) if self.tracer else self.download
+            futures = dict([ (pool.submit(download, *j), j[1]) for j in jobs ])
+            for fut in as_completed(futures):
+                dest = futures[fut]
+                ndone += 1
+                error = None
+                try:
+                    nbytes += fut.result()
+                except Exception as e:
+                    error = str(e) or e.__class__.__name__
+                    failed[dest] = error
+                if progress:
+                    progress(dest, ndone, len(futures), error)
+        return (nbytes, failed)
+
+class RunDatabase(object):
+    """Local SQLite database recording the metadata of all runs seen by the `sync' command."""
+    filename = "runs.db"
+    DB = None
+
+    def __init__(self, filename="runs.db"):
+        self.filename = filename
+        self.DB = SQLiteDatabase([DBTable("runs",
+                                          ("Id", "V32,P"),
+                                          ("ExperimentName", "T,X"),
+                                          ("DateModified", "V32")),
+                                  DBTable("runinfo",
+                                          ("RunId", "V32,X"),
+                                          ("Idx", "I"),
+                                          ("Key", "T"),
+                                          ("Value", "T")),
+                                  DBTable("syncinfo",
+                                          ("Key", "V32,P"),
+                                          ("Value", "T"))],
+                                 filename=filename)
+
+    def __enter__(self):
+        self.DB.__enter__()
+        n = self.DB.getValue("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='runs';")
+        if n == 0:
+            self.DB.create()
+            self.DB.commit()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.DB.commit()
+        self.DB.__exit__(type, value, traceback)
+
+    def commit(self):
+        self.DB.commit()
+
+    def getWatermark(self):
+        """Returns the highest DateModified seen at the end of the last complete sync, or None."""
+        row = self.DB.execute("SELECT Value FROM syncinfo WHERE Key='watermark';").fetchone()
+        return row[0] if row else None
+
+    def setWatermark(self, value):
+        self.DB.execute("INSERT OR REPLACE INTO syncinfo (Key, Value) VALUES ('watermark', ?);", (value,))
+
+    def getModified(self, runid):
+        """Returns the DateModified stored for run `runid', or None if the run is not known."""
+        row = self.DB.execute("SELECT DateModified FROM runs WHERE Id=?;", (runid,)).fetchone()
+        return row[0] if row else None
+
+    def storeRun(self, runid, name, modified, runinfo):
+        """Store (or replace) run `runid' with its list of (key, value) pairs `runinfo'."""
+        self.DB.execute("INSERT OR REPLACE INTO runs (Id, ExperimentName, DateModified) VALUES (?, ?, ?);",
+                        (runid, name, modified))
+        self.DB.execute("DELETE FROM runinfo WHERE RunId=?;", (runid,))
+        idx = 0
+        for (key, value) in runinfo:
+            self.DB.execute("INSERT INTO runinfo (RunId, Idx, Key, Value) VALUES (?, ?, ?, ?);",
+                            (runid, idx, key, value))
+            idx += 1
+
+    def getRunInfo(self, runid):
+        """Returns the stored (key, value) pairs for run `runid', in the original order."""
+        return self.DB.execute("SELECT Key, Value FROM runinfo WHERE RunId=? ORDER BY Idx;", (runid,)).fetchall()
+
 class BSClient():
     bspath = "bs"
+    apiserver = "https://api.basespace.illumina.com/"
     config = None
     command = None
+    syncdb = "runs.db"
+    nthreads = 8                # Number of concurrent bs calls for batch commands
+    timeout = None              # Timeout (in seconds) for each bs call
+    outfile = None
+    bwlimit = None              # Bandwidth cap for downloads, in bytes/second
+    tracer = None
     args = []
 
     def __init__(self, cmd=None, bspath="bs"):
@@ -38,7 +365,26 @@ class BSClient():
             if prev == "-c":
                 self.config = a
                 prev = ""
-            elif a in ["-c"]:
+            elif prev == "-d":
+                self.syncdb = a
+                prev = ""
+            elif prev == "-j":
+                self.nthreads = int(a)
+                prev = ""
+            elif prev == "-T":
+                self.timeout = int(a)
+                prev = ""
+            elif prev == "-o":
+                self.outfile = a
+                prev = ""
+            elif prev == "-t":
+                self.setTrace(a)
+                prev = ""
+            elif prev == "-b":
+                (v, mult) = decodeUnits(a)
+                self.bwlimit = float(v) * mult
+                prev = ""
+            elif a in ["-c", "-d", "-j", "-T", "-o", "-b", "-t"]:
                 prev = a
             elif not self.command:
                 if a in COMMANDS:
@@ -57,32 +403,84 @@ Usage: bspace.py command arguments...
 
 Where command is one of: {}
 
-""".format(", ".join(COMMANDS)))
+Options:
+
+  -c C | Use BaseSpace configuration C.
+  -d D | Use D as the run database for the sync command (default: {}).
+  -j J | Number of concurrent BaseSpace calls or downloads (default: {}).
+  -T T | Abort BaseSpace calls taking longer than T seconds.
+  -o O | Write allreads report to file O (JSON if O ends in .json, otherwise TSV).
+  -b B | Limit total download bandwidth to B bytes/second (M and G suffixes allowed).
+  -t F | Write timing traces (JSON lines) to file F (- for stderr), and a summary at exit.
+
+The sync command updates the directories of runs that changed since the last sync;
+use `sync -f' to update all runs.
+The allreads command accepts project names, or @F to read project names from file F.
+The download command takes a project name and a run directory, and downloads the
+project's FASTQ files to the fastq/ subdirectory of the run directory.
+
+""".format(", ".join(COMMANDS), self.syncdb, self.nthreads))
+
+    def setTrace(self, filename):
+        """Enable tracing of bs calls to `filename' (or stderr if filename is "-")."""
+        stream = sys.stderr if filename == "-" else open(filename, "w")
+        self.tracer = Tracer(stream)
+        atexit.register(self.tracer.summary)
 
     def callBS(self, arguments, fmt="csv", token=False):
         """Low-level method to call bs with the supplied arguments. If `fmt' is "csv" (the default)
 the result is a string, while if it is "json" the result is a parsed JSON dictionary."""
 
-        cmdline = self.bspath + " --api-server https://api.basespace.illumina.com/ " 
+        cmdline = self.bspath + " --api-server " + self.apiserver + " "
         if token:
             cmdline += "--access-token " + token + " "
         cmdline += " ".join(arguments)
         if self.config:
             cmdline += " -c " + self.config
         cmdline += " -f " + fmt
-        result = subprocess.check_output(cmdline, shell=True)
+        if self.tracer:
+            return self.tracedCall(arguments, cmdline, fmt)
+        result = subprocess.check_output(cmdline, shell=True, universal_newlines=True, timeout=self.timeout)
         if fmt == "json":
             return json.loads(result)
         else:
             return result
 
+    def tracedCall(self, arguments, cmdline, fmt):
+        """Like callBS, but records spawn, wall and parse times and output size in the tracer."""
+        cmdtype = " ".join([ a for a in arguments if not a.startswith("-") ][:2])
+        start = time.time()
+        proc = subprocess.Popen(cmdline, shell=True, stdout=subprocess.PIPE)
+        spawn = time.time() - start
+        try:
+            raw = proc.communicate(timeout=self.timeout)[0]
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise subprocess.TimeoutExpired(cmdline, self.timeout)
+        wall = time.time() - start
+        parse = 0.0
+        text = raw.decode().replace("\r\n", "\n").replace("\r", "\n") # As universal_newlines would
+        result = text
+        try:
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmdline, output=text)
+            if fmt == "json":
+                pstart = time.time()
+                result = json.loads(text)
+                parse = time.time() - pstart
+        finally:
+            self.tracer.record("bs", cmdtype, wall, spawn=spawn, nbytes=len(raw), parse=parse)
+        return result
+
+    @traced
     def getRunInfo(self, name):
         """Get all information on run `name'. Returns a list of pairs (key, value) in the order in which they were retrieved from BaseSpace."""
         p = self.callBS(["run", "get", "--name", name])
         lines = p.split("\n")
         hdr = lines[0].strip().split(",")
         data = lines[1].strip().split(",")
-        return zip(hdr, data)
+        return list(zip(hdr, data))
 
     def writeRunInfo(self, filename, runinfo):
         """Write run data `runinfo' to `filename' in tab-delimited format."""
@@ -94,7 +492,17 @@ the result is a string, while if it is "json" the result is a parsed JSON dictio
         stream.write("{}:\t{}\n".format(label, d[key]))
 
     def writeMeta(self, filename, runinfo):
+        """Write the META file for a run. If the file already exists, its Description line (and
+anything following it, which is written by hand) is preserved."""
         d = dict(runinfo)
+        description = "Description:\t\n"
+        if os.path.isfile(filename):
+            with open(filename, "r") as f:
+                lines = f.readlines()
+            for i in range(len(lines)):
+                if lines[i].startswith("Description:"):
+                    description = "".join(lines[i:])
+                    break
         with open(filename, "w") as out:
             self.writeEntry(out, d, "Name", "ExperimentName")
             self.writeEntry(out, d, "ID", "Id")
@@ -103,29 +511,41 @@ the result is a string, while if it is "json" the result is a parsed JSON dictio
             self.writeEntry(out, d, "Instrument", "InstrumentName")
             self.writeEntry(out, d, "Flowcell", "FlowcellBarcode")
             self.writeEntry(out, d, "Date", "DateCreated")
-            out.write("Description:\t\n")
+            out.write(description)
 
+    @traced
     def initializeDirectory(self, name):
-        os.mkdir(name)
+        os.mkdir(name)          # Refuse to overwrite an existing run directory
         ri = self.getRunInfo(name)
-        self.writeRunInfo(name + "/runInfo.csv", ri)
-        self.writeMeta(name + "/META", ri)
-        os.mkdir(name + "/fastq")
+        self.updateDirectory(name, ri)
 
-    def getAllRuns(self, show=False):
+    def updateDirectory(self, name, runinfo):
+        """Write runInfo.csv and META for run `name', creating its directory if necessary."""
+        if not os.path.isdir(name):
+            os.mkdir(name)
+        self.writeRunInfo(name + "/runInfo.csv", runinfo)
+        self.writeMeta(name + "/META", runinfo)
+        if not os.path.isdir(name + "/fastq"):
+            os.mkdir(name + "/fastq")
+
+    @traced
+    def getAllRuns(self, show=False, fields=[]):
+        """Returns a list of dictionaries, one for each run. If `fields' is specified, only
+retrieve those fields."""
         if show:
             p = self.callBS(["run", "list"], fmt="table")
             sys.stdout.write(p)
             return
         result = []
-        p = self.callBS(["run", "list"])
-        rows = [ line.strip() for line in p.split("\n") ]
+        p = self.callBS(["run", "list"] + [ "-F " + f for f in fields ])
+        rows = [ line.strip() for line in p.split("\n") if line.strip() ]
         hdr = rows[0].split(",")
         for line in rows[1:]:
-            fields = line.strip().split(",")
-            result.append(dict(zip(hdr, fields)))
+            values = line.split(",")
+            result.append(dict(zip(hdr, values)))
         return result
 
+    @traced
     def getRunProjects(self, runid):
         projects = []
         apps = self.callBS(["list", "appsessions", "--input-run", runid], fmt="json")
@@ -146,10 +566,45 @@ the result is a string, while if it is "json" the result is a parsed JSON dictio
             self.initializeDirectory(name)
             sys.stderr.write("done.\n")
 
+    @traced
+    def syncRuns(self, force=False):
+        """Incrementally synchronize run directories with BaseSpace. A single `run list' call
+retrieves the DateModified of all runs; only runs whose DateModified differs from the one
+stored in the run database (or that are not present in it) are re-queried and have their
+directories updated. The latest DateModified seen is kept in the database as a watermark
+for reporting. If `force' is True, all runs are re-queried."""
+        nchanged = 0
+        with RunDatabase(self.syncdb) as RDB:
+            watermark = RDB.getWatermark()
+            newmark = watermark
+            for run in self.getAllRuns(fields=SYNC_FIELDS):
+                runid = run["Id"]
+                modified = run.get("DateModified", "")
+                if modified and (newmark is None or modified > newmark):
+                    newmark = modified
+                if not force and modified and RDB.getModified(runid) == modified:
+                    continue
+                name = run["ExperimentName"]
+                sys.stderr.write("{}... ".format(name))
+                ri = self.getRunInfo(name)
+                self.updateDirectory(name, ri)
+                RDB.storeRun(runid, name, modified, ri)
+                RDB.commit()    # Keep completed runs if we're interrupted
+                sys.stderr.write("done.\n")
+                nchanged += 1
+            # Only advance the watermark once all runs have been processed
+            if newmark:
+                RDB.setWatermark(newmark)
+        sys.stderr.write("{} runs updated (latest modification: {}).\n".format(nchanged, newmark or "none"))
+        return nchanged
+
     def callAPI(self):
-        print self.callBS(self.args)
+        sys.stdout.write(self.callBS(self.args))
 
+    @traced
     def projectReads(self, proj, token=False, write=False):
+        """Returns a tuple (totalReads, samples) for project `proj', where samples is a list
+of [name, reads] pairs sorted by name. If `write' is True, also print the samples to stdout."""
         w = toList(self.callBS(["list", "datasets", "--project-name", proj], fmt="json", token=token))
         totalReads = 0
         samples = []
@@ -167,6 +622,120 @@ the result is a string, while if it is "json" the result is a parsed JSON dictio
 
         return (totalReads, samples)
 
+    @traced
+    def allProjectReads(self, projects, out, fmt="tsv", token=False, progress=None):
+        """Compute read counts for all projects in `projects', running up to `nthreads' bs
+calls at the same time. Results are written to stream `out' (in TSV or JSON format, according
+to `fmt') as soon as each project completes, so report order is completion order. If
+supplied, `progress' is called as progress(project, ndone, ntotal, error) after each project.
+Returns a dictionary mapping the projects that failed to their error message."""
+        failed = {}
+        ndone = 0
+        first = True
+        if fmt == "json":
+            out.write("[\n")
+        else:
+            out.write("Project\tSample\tReads\tPct\n")
+        with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+            projectReads = self.tracer.propagate(self.projectReads) if self.tracer else self.projectReads
+            jobs = dict([ (pool.submit(projectReads, proj, token=token), proj) for proj in projects ])
+            for job in as_completed(jobs):
+                proj = jobs[job]
+                ndone += 1
+                error = None
+                try:
+                    (totalReads, samples) = job.result()
+                except Exception as e:
+                    error = str(e) or e.__class__.__name__
+                    failed[proj] = error
+                else:
+                    if fmt == "json":
+                        if not first:
+                            out.write(",\n")
+                        json.dump({"Project": proj, "TotalReads": totalReads, "Samples": dict(samples)}, out)
+                        first = False
+                    else:
+                        for s in samples:
+                            pct = 100.0 * s[1] / totalReads if totalReads else 0.0
+                            out.write("{}\t{}\t{}\t{:.2f}\n".format(proj, s[0], s[1], pct))
+                        out.write("{}\tTOTAL\t{}\t100.00\n".format(proj, totalReads))
+                    out.flush()
+                if progress:
+                    progress(proj, ndone, len(jobs), error)
+        if fmt == "json":
+            out.write("\n]\n")
+        return failed
+
+    def showProgress(self, proj, ndone, ntotal, error):
+        sys.stderr.write("[{}/{}] {}: {}\n".format(ndone, ntotal, proj, "ERROR" if error else "done"))
+
+    def allReads(self):
+        projects = []
+        for a in self.args:
+            if a.startswith("@"):
+                with open(a[1:], "r") as f:
+                    projects += [ line.strip() for line in f if line.strip() ]
+            else:
+                projects.append(a)
+        fmt = "json" if self.outfile and self.outfile.endswith(".json") else "tsv"
+        if self.outfile:
+            with open(self.outfile, "w") as out:
+                failed = self.allProjectReads(projects, out, fmt=fmt, progress=self.showProgress)
+        else:
+            failed = self.allProjectReads(projects, sys.stdout, fmt=fmt, progress=self.showProgress)
+        sys.stderr.write("{} projects processed, {} failed.\n".format(len(projects), len(failed)))
+        for proj in sorted(failed.keys()):
+            sys.stderr.write("  {}: {}\n".format(proj, failed[proj]))
+        return failed
+
+    def getAccessToken(self):
+        """Read the access token from the bs configuration file."""
+        cfgfile = os.path.expanduser("~/.basespace/{}.cfg".format(self.config or "default"))
+        with open(cfgfile, "r") as f:
+            for line in f:
+                parts = line.split("=", 1)
+                if len(parts) == 2 and parts[0].strip() == "accessToken":
+                    return parts[1].strip()
+        return None
+
+    @traced
+    def getProjectFiles(self, proj, token=False):
+        """Returns a list of dictionaries (with keys Id, FilePath, Size, ETag) describing the
+files in all datasets of project `proj'."""
+        result = []
+        datasets = toList(self.callBS(["list", "datasets", "--project-name", proj], fmt="json", token=token))
+        for ds in datasets:
+            if "Id" in ds:
+                result += toList(self.callBS(["contents", "dataset", "--id", ds["Id"]], fmt="json", token=token))
+        return result
+
+    def fileURL(self, fileid):
+        return self.apiserver + "v2/files/{}/content".format(fileid)
+
+    @traced
+    def downloadProject(self, proj, rundir, token=False):
+        """Download all files in project `proj' to the fastq/ subdirectory of `rundir', using
+`nthreads' parallel transfers. Returns a dictionary of the files that failed."""
+        token = token or self.getAccessToken()
+        fqdir = rundir + "/fastq"
+        if not os.path.isdir(fqdir):
+            os.makedirs(fqdir)
+        jobs = []
+        for entry in self.getProjectFiles(proj, token=token):
+            etag = entry.get("ETag", "")
+            md5 = etag.strip('"') if len(etag.strip('"')) == 32 else None # multipart ETags are not MD5s
+            size = int(entry["Size"]) if "Size" in entry else None
+            dest = fqdir + "/" + os.path.basename(entry["FilePath"])
+            jobs.append((self.fileURL(entry["Id"]), dest, size, md5))
+        D = FileDownloader(nthreads=self.nthreads, bwlimit=self.bwlimit, headers={"x-access-token": token}, tracer=self.tracer)
+        start = time.time()
+        (nbytes, failed) = D.downloadAll(jobs, progress=self.showProgress)
+        elapsed = time.time() - start
+        sys.stderr.write("{} files, {} bytes downloaded in {:.1f}s, {} failed.\n".format(len(jobs), nbytes, elapsed, len(failed)))
+        for dest in sorted(failed.keys()):
+            sys.stderr.write("  {}: {}\n".format(dest, failed[dest]))
+        return failed
+
     def runReport(self):
         R = NGSReport(self.args[0], self.args[1], self.args[2], self.args[3])
         R.run(self)
@@ -179,10 +748,16 @@ the result is a string, while if it is "json" the result is a parsed JSON dictio
                 self.initializeDirectory(name)
         elif self.command == "all":
             self.initializeAllDirectories()
+        elif self.command == "sync":
+            self.syncRuns(force=("-f" in self.args))
         elif self.command == "api":
             self.callAPI()
         elif self.command == "nreads":
             self.projectReads(self.args[0], write=True)
+        elif self.command == "allreads":
+            self.allReads()
+        elif self.command == "download":
+            self.downloadProject(self.args[0], self.args[1])
         elif self.command == "report":
             self.runReport()
 
@@ -11,7 +11,10 @@ __version__   = "1.0"
 
 import sys
 import sqlite3 as sql
-import mysql.connector as mysql
+try:
+    import mysql.connector as mysql
+except ImportError:
+    mysql = None                # Only needed by MySQLDatabase
 
 def dget(dict, key):
     if key in dict:
@@ -125,13 +128,15 @@ class Database(object):
         self._lvl += 1
         if not self._conn:
             self._conn = self.connect()
-        return self._conn.cursor()
+            self._curs = self._conn.cursor()
+        return self._curs
 
     def __exit__(self, type, value, traceback):
         self._lvl += -1
         if self._lvl == 0:
             self._conn.close()
             self._conn = None
+            self._curs = None
 
     def addTable(self, tab):
         self.tables[tab.name] = tab
@@ -12,20 +12,28 @@ each of which is represented by multiple samples, and a list of contrasts betwee
 """
 
 import sys
+import itertools
 from BIutils import BIcsv
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 class Experiment(object):
     conditions = []             # list of all conditions
     condsamples = {}            # samples associated with each condition
     samples = []                # list of all samples
     samplescond = []            # index of condition for each sample
     samplecondname = {}         # condition name associated with each sample
+    sampleindex = {}            # position of each sample in self.samples
     contrasts = []
 
     def __init__(self):
         self.conditions = []
         self.condsamples = {}
         self.samplecondname = {}
+        self.sampleindex = {}
         self.samples = []
         self.samplescond = []
         self.contrasts = []
@@ -35,8 +43,10 @@ class Experiment(object):
 if any of the samples has already been defined."""
         cidx = len(self.conditions)
         for cs in csamples:
-            if cs in self.samples:
+            if cs in self.sampleindex:
                 sys.stderr.write("Warning: duplicate sample name `{}'.\n".format(cs))
+            else:
+                self.sampleindex[cs] = len(self.samples)
             self.samples.append(cs)
             self.samplescond.append(cidx)
             self.samplecondname[cs] = cname
@@ -93,19 +103,141 @@ test condition, and control condition."""
         """Return the labels for the specified samples as a list."""
         result = []
         for smp in samples:
-            idx = 0
-            found = False
-            for s in self.samples:
-                if s == smp:
-                    result.append(self.conditions[self.samplescond[idx]])
-                    found = True
-                idx += 1
-            if not found:
+            if smp not in self.sampleindex:
                 sys.stderr.write("Error: column `{}' not found in conditions file.\n".format(smp))
                 sys.exit(1)
+            result.append(self.conditions[self.samplescond[self.sampleindex[smp]]])
         return result
-                
+
+    def conditionCodes(self):
+        """Returns a NumPy integer array with one element for each sample, being the index of its condition."""
+        return np.array(self.samplescond, dtype=np.int32)
+
+    def getSampleCodes(self, samples, strict=True):
+        """Return a NumPy integer array containing the index of the condition of each of the
+specified samples (eg the columns of a header row). If `strict' is False, samples not found
+in the conditions file get code -1, otherwise they cause an error."""
+        idx = np.fromiter((self.sampleindex.get(smp, -1) for smp in samples), dtype=np.int64, count=len(samples))
+        missing = idx < 0
+        if strict and missing.any():
+            sys.stderr.write("Error: column `{}' not found in conditions file.\n".format(samples[int(np.argmax(missing))]))
+            sys.exit(1)
+        codes = self.conditionCodes()[idx]
+        codes[missing] = -1
+        return codes
+
+    def getSampleLabelArray(self, samples, strict=True):
+        """Like getSampleLabels, but returns a NumPy array of condition names. Samples not found
+in the conditions file are labeled with the empty string if `strict' is False."""
+        codes = self.getSampleCodes(samples, strict=strict)
+        labels = np.array(self.conditions + [""], dtype=object)
+        return labels[codes]
+
+    def contrastDesign(self, columns, pseudocount=1.0):
+        """Returns a ContrastDesign for a data matrix whose header row (row ID column, then sample names) is `columns'."""
+        return ContrastDesign(self, columns, pseudocount=pseudocount)
+
     def dump(self):
         sys.stdout.write("Conditions: {}\n".format(", ".join(self.conditions)))
         sys.stdout.write("Samples: {}\n".format(", ".join(self.samples)))
         sys.stdout.write("Contrasts: {}\n".format(", ".join(self.conditions)))
+
+class ContrastDesign(object):
+    """The layout of all contrasts of an Experiment over a tab-delimited data matrix whose
+header row is `columns'. The first column contains row IDs; other columns that do not
+belong to any condition are ignored. Group means,
+log2 fold changes and Welch t statistics for all contrasts are computed together, so a
+count matrix only needs to be read once regardless of the number of contrasts."""
+    experiment = None
+    columns = []                # header of the matrix: row ID column, then sample names
+    used = None                 # indexes of the columns that belong to a condition
+    codes = None                # condition index of each used column
+    design = None               # used columns x conditions 0/1 matrix
+    sizes = None                # number of used columns in each condition
+    testidx = None              # test condition index of each contrast
+    ctrlidx = None              # control condition index of each contrast
+    testcols = []               # data column indexes for the test side of each contrast
+    ctrlcols = []               # data column indexes for the control side of each contrast
+    pseudocount = 1.0
+
+    def __init__(self, experiment, columns, pseudocount=1.0):
+        self.experiment = experiment
+        self.columns = list(columns)
+        self.pseudocount = pseudocount
+        allcodes = experiment.getSampleCodes(self.columns, strict=False)
+        if allcodes[0] >= 0:
+            sys.stderr.write("Error: the first column `{}' should contain row IDs, not a sample.\n".format(self.columns[0]))
+            sys.exit(1)
+        self.used = np.nonzero(allcodes >= 0)[0]
+        self.codes = allcodes[self.used]
+        nconds = len(experiment.conditions)
+        self.design = np.zeros((len(self.used), nconds))
+        self.design[np.arange(len(self.used)), self.codes] = 1.0
+        self.sizes = self.design.sum(axis=0)
+        self.testidx = np.array([ experiment.conditions.index(c[0]) for c in experiment.contrasts ], dtype=np.int64)
+        self.ctrlidx = np.array([ experiment.conditions.index(c[1]) for c in experiment.contrasts ], dtype=np.int64)
+        self.testcols = [ np.nonzero(allcodes == t)[0] for t in self.testidx ]
+        self.ctrlcols = [ np.nonzero(allcodes == c)[0] for c in self.ctrlidx ]
+
+    def contrastNames(self):
+        return [ "{}_vs_{}".format(c[0], c[1]) for c in self.experiment.contrasts ]
+
+    def groupStats(self, data):
+        """Returns the per-row means and sample variances of each condition for `data', a
+matrix with one column for each used column (see self.used). Both results have one
+column per condition; variances of conditions with fewer than two samples are NaN."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = (data @ self.design) / self.sizes
+            dev = data - means[:, self.codes]
+            var = ((dev * dev) @ self.design) / (self.sizes - 1)
+        var[:, self.sizes < 2] = np.nan
+        return (means, var)
+
+    def evaluate(self, data):
+        """Evaluate all contrasts on `data' (as in groupStats). Returns a tuple (means, log2fc, t):
+`means' has one column per condition, `log2fc' and `t' (Welch t statistic) one column per contrast."""
+        (means, var) = self.groupStats(data)
+        mt = means[:, self.testidx]
+        mc = means[:, self.ctrlidx]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            log2fc = np.log2((mt + self.pseudocount) / (mc + self.pseudocount))
+            se = np.sqrt(var[:, self.testidx] / self.sizes[self.testidx] + var[:, self.ctrlidx] / self.sizes[self.ctrlidx])
+            t = (mt - mc) / se
+        return (means, log2fc, t)
+
+    def evaluateFile(self, filename, chunksize=10000):
+        """Generator that reads the tab-delimited matrix in `filename' (whose columns are
+self.columns) `chunksize' rows at a time, returning a tuple (ids, means, log2fc, t) for
+each chunk. The first line is skipped if it is the header."""
+        usecols = self.used.tolist()
+        with open(filename, "r") as f:
+            first = True
+            while True:
+                chunk = list(itertools.islice(f, chunksize))
+                if not chunk:
+                    return
+                if first:
+                    first = False
+                    if chunk[0].rstrip("\r\n").split("\t") == self.columns:
+                        chunk = chunk[1:]
+                lines = [ line for line in chunk if line.strip() and line[0] != '#' ]
+                if lines:
+                    ids = [ line.split("\t", 1)[0] for line in lines ]
+                    data = np.loadtxt(lines, dtype=float, delimiter="\t", usecols=usecols, ndmin=2)
+                    yield (ids,) + self.evaluate(data)
+
+    def writeStats(self, filename, out=sys.stdout, chunksize=10000):
+        """Evaluate all contrasts on the matrix in `filename' and write a table to `out' with the
+mean of each condition, and the log2 fold change and t statistic of each contrast."""
+        hdr = [self.columns[0]] + [ c + ":mean" for c in self.experiment.conditions ]
+        for name in self.contrastNames():
+            hdr += [ name + ":log2FC", name + ":t" ]
+        out.write("\t".join(hdr) + "\n")
+        nc = len(self.testidx)
+        fmt = "%s\t" + "\t".join(["%.6g"] * (len(hdr) - 1)) + "\n"
+        for (ids, means, log2fc, t) in self.evaluateFile(filename, chunksize=chunksize):
+            stats = np.empty((len(ids), 2 * nc))
+            stats[:, 0::2] = log2fc
+            stats[:, 1::2] = t
+            rows = np.hstack([means, stats])
+            out.write("".join([ fmt % ((i,) + tuple(row)) for (i, row) in zip(ids, rows.tolist()) ]))
@@ -7,19 +7,29 @@ __license__   = "MIT"
 __date__      = "Mar 19 2019"
 __version__   = "1.0"
 
-from BImisc import shell, missingOrStale
+import os
+import sys
+import time
+import shlex
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from BIutils.BImisc import shell, missingOrStale, StatCache
 
 class File(object):
     directory = ""
     name = ""
     sources = []
+    rule = None                 # Shell command (string) or callable that builds this file
+    status = None               # Result of the last build: built, uptodate, failed, skipped
+    elapsed = None              # Time taken to build this file in the last build
     _pathname = None
     _nlines = None
 
-    def __init__(self, name, dir="", sources=[]):
+    def __init__(self, name, dir="", sources=[], rule=None):
         self.name = name
         self.directory = dir
         self.sources = sources
+        self.rule = rule
 
     def __str__(self):
         return self.pathname()
@@ -40,31 +50,54 @@ class File(object):
             self._nlines = int(s.split(" ")[0])
         return self._nlines
 
-    def stale(self):
+    def stale(self, cache=None):
         """Returns True if this file is older than at least one of its sources. If this
-file has no sources, always returns True."""
+file has no sources, always returns True. File information is looked up in `cache'
+(a StatCache) if supplied."""
         if self.sources:
             for s in self.sources:
-                if Utils.missingOrStale(self.pathname(), s.pathname()):
+                if missingOrStale(self.pathname(), s.pathname(), cache=cache):
                     return True
             return False
         else:
             return True
 
+    def make(self):
+        """Run the rule for this file. A string rule is executed as a shell command, after
+replacing {target} with the (shell-quoted) pathname of this file and {sources} with the
+pathnames of its sources; other braces in the command are left alone. A callable rule is
+called with this File as its argument. Returns True if the rule succeeded."""
+        if callable(self.rule):
+            return self.rule(self) is not False
+        sources = " ".join([ shlex.quote(s.pathname()) for s in self.sources ])
+        cmd = self.rule.replace("{target}", shlex.quote(self.pathname())).replace("{sources}", sources)
+        return sp.call(cmd, shell=True) == 0
+
 class Filer(object):
     _files = {}
     directory = ""
-    
-    def __init__(self, directory):
+    statcache = None
+
+    def __init__(self, directory, manifest=None):
+        """If `manifest' is a filename, staleness is decided by content hashes recorded in it
+(see BImisc.StatCache) instead of modification times."""
         self._files = {}
         self.directory = directory
+        self.statcache = StatCache(manifest=manifest)
 
-    def addFile(self, tag, name, sources=[], dir=None):
-        """Add the file `name' to this filer with the supplied `tag'."""
-        f = File(name, dir=dir or self.directory, sources=sources)
+    def addFile(self, tag, name, sources=[], dir=None, rule=None):
+        """Add the file `name' to this filer with the supplied `tag'. `sources' is a list
+of Files or tags of files already in this filer. `rule' is the command or callable
+used to build the file (see File.make)."""
+        srcs = [ self._files[src] if isinstance(src, str) else src for src in sources ]
+        f = File(name, dir=dir or self.directory, sources=srcs, rule=rule)
         self._files[tag] = f
         return f
 
+    def addRule(self, tag, rule):
+        """Set the rule used to build the file with the supplied `tag'."""
+        self._files[tag].rule = rule
+
     def file(self, tag):
         """Return the file having the supplied `tag' in this filer."""
         if tag in self._files:
@@ -79,3 +112,117 @@ class Filer(object):
             return f.pathname()
         else:
             return None
+
+    def targets(self, tags=None):
+        """Returns the files needed to build the files with the supplied `tags' (all files
+if not specified) in topological order, sources first. Returns None if the
+dependencies contain a cycle."""
+        roots = [ self._files[t] for t in tags ] if tags else list(self._files.values())
+        order = []
+        state = {}              # id -> 1 while visiting, 2 when done
+        stack = [ (f, False) for f in reversed(roots) ]
+        while stack:
+            (f, expanded) = stack.pop()
+            k = id(f)
+            if expanded:
+                state[k] = 2
+                order.append(f)
+            elif k not in state:
+                state[k] = 1
+                stack.append((f, True))
+                for src in reversed(f.sources):
+                    sk = state.get(id(src))
+                    if sk == 1:
+                        sys.stderr.write("Error: dependency cycle involving `{}'.\n".format(src.pathname()))
+                        return None
+                    if sk is None:
+                        stack.append((src, False))
+        return order
+
+    def build(self, tags=None, jobs=1, force=False, verbose=False):
+        """Build the files with the supplied `tags' (all files if not specified), running the
+rules of stale targets in dependency order with at most `jobs' rules at a time. A target
+is rebuilt if it is missing, older than one of its sources, or one of its sources was
+rebuilt (or always, if `force' is True). A missing file without a rule fails, and targets
+depending on a failed target are skipped. Returns True if nothing failed."""
+        order = self.targets(tags)
+        if order is None:
+            return False
+        cache = self.statcache
+        cache.clear()
+        for d in set([ os.path.dirname(os.path.abspath(f.pathname())) for f in order ]):
+            cache.prefetch(d)
+        pending = {}            # File -> number of sources not yet done
+        users = {}              # File -> files that have it as a source
+        for f in order:
+            f.status = None
+            f.elapsed = None
+            pending[f] = len(f.sources)
+            for src in f.sources:
+                users.setdefault(src, []).append(f)
+        ready = [ f for f in order if pending[f] == 0 ]
+        running = {}
+        good = True
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            while ready or running:
+                while ready:
+                    f = ready.pop(0)
+                    if any([ src.status in ["failed", "skipped"] for src in f.sources ]):
+                        f.status = "skipped"
+                        self._done(f, users, pending, ready)
+                    elif not f.rule and cache.stat(f.pathname()) is None:
+                        sys.stderr.write("Error: no rule to make `{}'.\n".format(f.pathname()))
+                        f.status = "failed"
+                        good = False
+                        self._done(f, users, pending, ready)
+                    elif f.rule and (force or self._needed(f)):
+                        if verbose:
+                            sys.stderr.write("[Building: {}]\n".format(f.pathname()))
+                        running[pool.submit(self._make, f)] = f
+                    else:
+                        f.status = "uptodate"
+                        self._done(f, users, pending, ready)
+                if running:
+                    (done, notdone) = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        f = running.pop(fut)
+                        cache.invalidate(f.pathname())
+                        if fut.result():
+                            cache.record(f.pathname(), [ src.pathname() for src in f.sources ])
+                        else:
+                            good = False
+                        self._done(f, users, pending, ready)
+        cache.save()
+        return good
+
+    def _needed(self, f):
+        """A target with sources is needed if it is stale or a source was rebuilt; one without is needed if missing."""
+        if f.sources:
+            return any([ src.status == "built" for src in f.sources ]) or f.stale(self.statcache)
+        return missingOrStale(f.pathname(), cache=self.statcache)
+
+    def _make(self, f):
+        start = time.time()
+        try:
+            ok = f.make()
+        except Exception as e:
+            sys.stderr.write("Error building `{}': {}\n".format(f.pathname(), e))
+            ok = False
+        f.elapsed = time.time() - start
+        f.status = "built" if ok else "failed"
+        if not ok:
+            sys.stderr.write("Error: rule for `{}' failed.\n".format(f.pathname()))
+        return ok
+
+    def _done(self, f, users, pending, ready):
+        for u in users.get(f, []):
+            pending[u] -= 1
+            if pending[u] == 0:
+                ready.append(u)
+
+    def report(self, out=sys.stderr):
+        """Write the status and build time of each file involved in the last build to `out'."""
+        for (tag, f) in self._files.items():
+            if f.status:
+                out.write("{:20} {:10} {:>9} {}\n".format(tag, f.status, "" if f.elapsed is None else "{:.2f}s".format(f.elapsed), f.pathname()))
+        out.write("{} stat calls, {} saved by cache.\n".format(self.statcache.calls, self.statcache.saved()))
@@ -8,8 +8,15 @@ __date__      = "Mar 19 2019"
 __version__   = "1.0"
 
 import sys
+import time
 import gzip
+import json
+import stat
+import shlex
 import os.path
+import queue
+import hashlib
+import threading
 import subprocess as sp
 
 # Global
@@ -18,15 +25,138 @@ SHELL_VERBOSE = False
 
 # Utilities
 
-def missingOrStale(target, reference=None):
-    """Return True if file `target' is missing, or is older than `reference'."""
-    if not os.path.isfile(target):
+def missingOrStale(target, reference=None, cache=None):
+    """Return True if file `target' is missing, or is older than `reference'.
+If `cache' (a StatCache) is supplied, file information is looked up in it."""
+    if cache:
+        return cache.missingOrStale(target, reference)
+    try:
+        tst = os.stat(target)
+    except OSError:
+        return True
+    if not stat.S_ISREG(tst.st_mode):
         return True
     if reference:
-        return os.path.getmtime(target) < os.path.getmtime(reference)
+        return tst.st_mtime < os.path.getmtime(reference)
     else:
         return False
 
+class StatCache(object):
+    """Remembers the result of os.stat for each path, so that checking the staleness of many
+targets sharing the same sources stats each file only once per scan. The names in whole
+directories can be listed at once with prefetch(), so that missing files in them need no
+stat call at all. If `manifest' is a filename, staleness is decided by
+comparing SHA-1 digests of the sources with those recorded (by record()) when the target
+was last built, instead of modification times."""
+    stats = {}                  # path -> stat result, or None if missing
+    digests = {}                # path -> (size, mtime_ns, digest)
+    listed = {}                 # directory -> set of names, for directories listed by prefetch()
+    manifest = None
+    recorded = {}               # target -> {source: digest}
+    calls = 0                   # number of actual os.stat calls
+    hits = 0                    # number of stat requests answered from the cache
+
+    def __init__(self, manifest=None):
+        self.stats = {}
+        self.digests = {}
+        self.listed = {}
+        self.manifest = manifest
+        self.recorded = {}
+        if manifest and os.path.isfile(manifest):
+            with open(manifest, "r") as f:
+                self.recorded = json.load(f)
+
+    def clear(self):
+        """Start a new scan, forgetting all stat results (digests are kept, since they are
+revalidated against size and modification time)."""
+        self.stats = {}
+        self.listed = {}
+
+    def invalidate(self, path):
+        """Forget the stat result for `path' (eg after it was rewritten)."""
+        path = os.path.abspath(path)
+        self.stats.pop(path, None)
+        names = self.listed.get(os.path.dirname(path))
+        if names is not None:
+            names.add(os.path.basename(path))
+
+    def prefetch(self, directory):
+        """List the names in `directory' with a single scandir. Paths in this directory that were
+not listed are then known to be missing without a stat call; the others are still only
+stat'ed when first requested."""
+        directory = os.path.abspath(directory)
+        try:
+            with os.scandir(directory) as it:
+                self.listed[directory] = set([ entry.name for entry in it ])
+        except OSError:
+            pass
+
+    def stat(self, path):
+        """Returns the stat result for `path', or None if it does not exist."""
+        path = os.path.abspath(path)
+        if path in self.stats:
+            self.hits += 1
+            return self.stats[path]
+        names = self.listed.get(os.path.dirname(path))
+        if names is not None and os.path.basename(path) not in names:
+            self.hits += 1
+            return None
+        self.calls += 1
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        self.stats[path] = st
+        return st
+
+    def saved(self):
+        """Returns the number of stat calls avoided so far."""
+        return self.hits
+
+    def digest(self, path):
+        """Returns the SHA-1 digest of the contents of `path', or None if it does not exist.
+Digests are recomputed only when the size or modification time of the file changes."""
+        st = self.stat(path)
+        if st is None:
+            return None
+        path = os.path.abspath(path)
+        d = self.digests.get(path)
+        if d and d[0] == st.st_size and d[1] == st.st_mtime_ns:
+            return d[2]
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(1048576)
+                if not block:
+                    break
+                h.update(block)
+        self.digests[path] = (st.st_size, st.st_mtime_ns, h.hexdigest())
+        return h.hexdigest()
+
+    def missingOrStale(self, target, reference=None):
+        """Like the missingOrStale function, using cached information. A missing reference makes the target stale."""
+        tst = self.stat(target)
+        if tst is None or not stat.S_ISREG(tst.st_mode):
+            return True
+        if not reference:
+            return False
+        if self.manifest:
+            known = self.recorded.get(os.path.abspath(target), {})
+            return known.get(os.path.abspath(reference)) != self.digest(reference)
+        rst = self.stat(reference)
+        return rst is None or tst.st_mtime < rst.st_mtime
+
+    def record(self, target, sources):
+        """Remember the digests of `sources' as the ones `target' was built from (content-hash mode only)."""
+        if self.manifest:
+            self.recorded[os.path.abspath(target)] = dict([ (os.path.abspath(s), self.digest(s)) for s in sources ])
+
+    def save(self):
+        """Write the recorded digests to the manifest file."""
+        if self.manifest:
+            with open(self.manifest, "w") as f:
+                json.dump(self.recorded, f, indent=1)
+
 def shell(commandline, verbose=SHELL_VERBOSE):
     """Execute the specified command in a subshell. If `verbose' is True,
 Prints the command being executed to standard error."""
@@ -34,6 +164,120 @@ Prints the command being executed to standard error."""
         sys.stderr.write("[Executing: " + commandline + "]\n")
     return sp.check_output(commandline, shell=True)
 
+class Job(object):
+    """A shell command run by a JobRunner, with its outcome."""
+    name = ""
+    command = ""
+    stdout = ""                 # Log file for standard output
+    stderr = ""                 # Log file for standard error
+    returncode = None
+    attempts = 0
+    wall = 0.0                  # Elapsed time of the last attempt
+    cpu = 0.0                   # User + system CPU time of the last attempt
+    maxrss = 0                  # Peak resident set size of the last attempt, in bytes
+    _proc = None
+    _start = None
+
+    def __init__(self, name, command, logdir):
+        self.name = name
+        self.command = command
+        self.stdout = os.path.join(logdir, name + ".out")
+        self.stderr = os.path.join(logdir, name + ".err")
+
+    def start(self):
+        mode = "a" if self.attempts else "w"
+        self.attempts += 1
+        with open(self.stdout, mode) as out, open(self.stderr, mode) as err:
+            self._start = time.time()
+            self._proc = sp.Popen(self.command, shell=True, stdout=out, stderr=err)
+        return self._proc.pid
+
+    def finished(self, status, usage):
+        self.wall = time.time() - self._start
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self._proc.returncode = self.returncode
+        self.cpu = usage.ru_utime + usage.ru_stime
+        self.maxrss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+class JobRunner(object):
+    """Run a batch of shell commands in parallel. At most `maxjobs' commands run at the
+same time (default: number of CPUs); if `memory' (bytes needed by each job) is specified,
+the limit is further reduced so that the jobs fit in the available memory. The standard
+output and error of each job are written to NAME.out and NAME.err in `logdir', and
+failed jobs are retried up to `retries' times.
+
+Example:
+  R = JobRunner(logdir="logs", retries=1)
+  for smp in samples:
+      R.add("bwa mem ref.fa {0}.fq > {0}.sam".format(smp), name=smp)
+  R.run()
+  R.report()
+"""
+    jobs = []
+    maxjobs = 1
+    logdir = "."
+    retries = 0
+    wall = 0.0
+
+    def __init__(self, maxjobs=None, logdir=".", retries=0, memory=None):
+        self.jobs = []
+        self.logdir = logdir
+        self.retries = retries
+        self.maxjobs = maxjobs or os.cpu_count() or 1
+        if memory:
+            try:
+                avail = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+                self.maxjobs = max(1, min(self.maxjobs, avail // memory))
+            except (ValueError, OSError, AttributeError):
+                pass
+
+    def add(self, command, name=None):
+        """Add `command' to the batch. Returns the new Job."""
+        job = Job(name or "job{}".format(len(self.jobs) + 1), command, self.logdir)
+        self.jobs.append(job)
+        return job
+
+    def run(self, verbose=SHELL_VERBOSE):
+        """Run all jobs. Returns True if all of them succeeded (possibly after retries)."""
+        if not os.path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+        queue = list(self.jobs)
+        running = {}
+        start = time.time()
+        while queue or running:
+            while queue and len(running) < self.maxjobs:
+                job = queue.pop(0)
+                if verbose:
+                    sys.stderr.write("[Executing: " + job.command + "]\n")
+                running[job.start()] = job
+            # Only wait on our own jobs, so that other children of this process are left alone
+            reaped = False
+            for pid in list(running.keys()):
+                (wpid, status, usage) = os.wait4(pid, os.WNOHANG)
+                if wpid == pid:
+                    reaped = True
+                    job = running.pop(pid)
+                    job.finished(status, usage)
+                    if job.returncode != 0 and job.attempts <= self.retries:
+                        queue.append(job)
+            if not reaped:
+                time.sleep(0.01)
+        self.wall = time.time() - start
+        return all([ job.returncode == 0 for job in self.jobs ])
+
+    def summary(self):
+        """Returns a list with one tuple for each job: (name, exit code, attempts, wall, cpu, maxrss)."""
+        return [ (job.name, job.returncode, job.attempts, job.wall, job.cpu, job.maxrss) for job in self.jobs ]
+
+    def report(self, out=sys.stdout):
+        """Write a table summarizing the outcome of all jobs to `out'."""
+        out.write("{:20} {:>5} {:>8} {:>10} {:>10} {:>10}\n".format("Job", "Exit", "Attempts", "Wall", "CPU", "MaxRSS"))
+        for (name, rc, attempts, wall, cpu, maxrss) in self.summary():
+            out.write("{:20} {:>5} {:>8} {:>10.2f} {:>10.2f} {:>10}\n".format(name, "" if rc is None else rc, attempts, wall, cpu, printWithUnits(maxrss)))
+        nfail = len([ job for job in self.jobs if job.returncode != 0 ])
+        out.write("{} jobs, {} failed, {:.2f}s elapsed, {:.2f}s CPU, {} jobs at a time.\n".format(
+            len(self.jobs), nfail, self.wall, sum([ job.cpu for job in self.jobs ]), self.maxjobs))
+
 def linkify(url, name, target="_blank"):
     if name is None:
         name = os.path.split(url)[1]
@@ -100,34 +344,205 @@ Returns None if f is not in the form N/D, or if D is 0."""
     else:
         return None
 
+class BackgroundWriter(object):
+    """A write-only stream that collects written strings into buffers of about `bufsize'
+characters and hands them to a background thread, which encodes, compresses (if the
+destination ends in .gz, at level `compresslevel') and writes them. At most `queuesize' buffers can be waiting;
+when the queue is full the producer blocks (a stall) until the writer catches up.
+If `destination' is None the output goes to sys.stdout."""
+    destination = None
+    bufsize = 1048576
+    compresslevel = 6
+    nbytes = 0                  # Characters written
+    stalls = 0                  # Number of times the producer had to wait
+    stalltime = 0.0             # Total time spent waiting
+    start = None
+    elapsed = 0.0
+    _buf = []
+    _buflen = 0
+    _queue = None
+    _thread = None
+    _error = None
+
+    def __init__(self, destination=None, bufsize=1048576, queuesize=8, compresslevel=6):
+        self.destination = destination
+        self.bufsize = bufsize
+        self.compresslevel = compresslevel
+        self._buf = []
+        self._buflen = 0
+        self._queue = queue.Queue(maxsize=queuesize)
+        self.start = time.time()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _writer(self):
+        try:
+            # Buffers are encoded and written whole, so zlib and the OS work on large
+            # blocks with the GIL released
+            if self.destination is None:
+                out = sys.stdout.buffer
+            elif self.destination.endswith(".gz"):
+                out = gzip.open(self.destination, "wb", compresslevel=self.compresslevel)
+            else:
+                out = open(self.destination, "wb")
+            while True:
+                data = self._queue.get()
+                if data is None:
+                    break
+                out.write(data.encode())
+            if self.destination is None:
+                out.flush()
+            else:
+                out.close()
+        except Exception as e:
+            self._error = e
+            while self._queue.get() is not None: # Keep draining so the producer does not block
+                pass
+
+    def _put(self, data):
+        if self._error:
+            raise self._error
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            t0 = time.time()
+            self._queue.put(data)
+            self.stalls += 1
+            self.stalltime += time.time() - t0
+
+    def write(self, s):
+        self._buf.append(s)
+        self._buflen += len(s)
+        self.nbytes += len(s)
+        if self._buflen >= self.bufsize:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Hand the current buffer to the writer thread."""
+        if self._buf:
+            self._put("".join(self._buf))
+            self._buf = []
+            self._buflen = 0
+
+    def close(self):
+        """Write out everything and wait for the writer thread to finish."""
+        self.flush()
+        self._put(None)
+        self._thread.join()
+        self.elapsed = time.time() - self.start
+        if self._error:
+            raise self._error
+
+    def report(self, out=sys.stderr):
+        rate = self.nbytes / self.elapsed if self.elapsed else 0
+        out.write("{} written to {} in {:.2f}s ({}/s), {} queue stalls ({:.2f}s).\n".format(
+            printWithUnits(self.nbytes), self.destination or "stdout", self.elapsed, printWithUnits(rate), self.stalls, self.stalltime))
+
 class Output():
     destination = sys.stdout
     out = None                  # stream
-    __doc__ = "A class that returns a stream to an open file, or sys.stdout if the filename is None or '-'."
+    background = False
+    bufsize = 1048576
+    queuesize = 8
+    verbose = False
+    __doc__ = """A class that returns a stream to an open file, or sys.stdout if the filename is None or '-'.
+If `background' is True the stream is a BackgroundWriter, so that writing (and compression)
+overlaps with the computation producing the output; if `verbose' is also True, throughput
+and queue stalls are reported to standard error when the stream is closed."""
 
-    def __init__(self, destination):
+    def __init__(self, destination, background=False, bufsize=1048576, queuesize=8, verbose=False):
         if destination != '-':
             self.destination = destination
+        self.background = background
+        self.bufsize = bufsize
+        self.queuesize = queuesize
+        self.verbose = verbose
 
     def __enter__(self):
-        if self.destination:
+        if self.background:
+            self.out = BackgroundWriter(self.destination if isinstance(self.destination, str) else None, bufsize=self.bufsize, queuesize=self.queuesize)
+        elif self.destination:
             self.out = genOpen(self.destination, "w")
         return self.out
 
     def __exit__(self, type, value, traceback):
-        if self.destination:
+        if self.background:
+            self.out.close()
+            if self.verbose:
+                self.out.report()
+        elif self.destination:
             self.out.close()
 
+_SCRIPT_HELPERS = """STEPLOG=${{STEPLOG:-{log}}}
+printf "step\\tgroup\\tstart\\tend\\texit\\n" > "$STEPLOG"
+_pids=()
+
+_now() {{
+  echo ${{EPOCHREALTIME:-$(date +%s.%N)}}
+}}
+
+# _step name group command: run command, logging its start and end time and exit code
+_step() {{
+  local start=$(_now)
+  eval "$3"
+  local rc=$?
+  printf "%s\\t%s\\t%s\\t%s\\t%s\\n" "$1" "$2" "$start" "$(_now)" "$rc" >> "$STEPLOG"
+  return $rc
+}}
+
+# _sem n: wait until fewer than n background jobs are running
+_sem() {{
+  while [ $(jobs -rp | wc -l) -ge $1 ]; do wait -n; done
+}}
+
+# _wait: wait for all background steps, failing if any of them failed
+_wait() {{
+  local rc=0
+  for p in "${{_pids[@]}}"; do wait $p || rc=$?; done
+  _pids=()
+  return $rc
+}}
+
+"""
+
 class ShellScript():
+    """A context manager that writes a bash script to `filename', returning its stream.
+Commands can be written to the stream directly, or added with step() and parallel(), in
+which case each step's start and end time and exit code are appended to a tab-delimited
+log (`log', default FILENAME.log, overridden at run time by $STEPLOG). Independent steps
+passed to parallel() run as background jobs, at most `maxjobs' at a time. If `stopOnError'
+is True, the script exits when a step (or a step in a parallel group) fails.
+
+Example:
+  S = ShellScript("pipeline.sh")
+  with S:
+      S.step("fastqc *.fastq.gz", name="qc")
+      S.parallel([ (smp, "bwa mem ref.fa {0}.fq > {0}.sam".format(smp)) for smp in samples ])
+      S.step("multiqc .", name="report")
+"""
     filename = ""
     out = None
+    log = None
+    maxjobs = 4
+    stopOnError = True
+    nsteps = 0
+    ngroups = 0
 
-    def __init__(self, filename):
+    def __init__(self, filename, log=None, maxjobs=4, stopOnError=True):
         self.filename = filename
+        self.log = log or filename + ".log"
+        self.maxjobs = maxjobs
+        self.stopOnError = stopOnError
 
     def __enter__(self):
         self.out = open(self.filename, "w")
         self.out.write("#!/bin/bash\n\n")
+        self.nsteps = 0
+        self.ngroups = 0
         return self.out
 
     def __exit__(self, type, value, traceback):
@@ -137,6 +552,49 @@ class ShellScript():
         except:
             pass
 
+    def _helpers(self):
+        if self.nsteps == 0:
+            self.out.write(_SCRIPT_HELPERS.format(log=self.log))
+
+    def _stepline(self, command, name, group):
+        self._helpers()
+        self.nsteps += 1
+        name = name or "step{}".format(self.nsteps)
+        return "_step {} {} {}".format(shlex.quote(name), shlex.quote(group), shlex.quote(command))
+
+    def step(self, command, name=None):
+        """Add a step running `command'."""
+        line = self._stepline(command, name, "-")
+        if self.stopOnError:
+            line += " || exit $?"
+        self.out.write(line + "\n")
+
+    def parallel(self, commands, maxjobs=None, name=None):
+        """Add a group of steps that run in parallel, waiting for all of them to finish.
+`commands' is a list of commands or (name, command) tuples. At most `maxjobs' (default:
+self.maxjobs) steps run at the same time."""
+        self.ngroups += 1
+        group = name or "group{}".format(self.ngroups)
+        maxjobs = maxjobs or self.maxjobs
+        self.out.write("\n# Parallel group {}\n".format(group))
+        for cmd in commands:
+            (sname, cmd) = cmd if isinstance(cmd, tuple) else (None, cmd)
+            line = self._stepline(cmd, sname, group)
+            self.out.write("_sem {}; {} &\n_pids+=($!)\n".format(maxjobs, line))
+        self.out.write("_wait" + (" || exit $?" if self.stopOnError else "") + "\n\n")
+
+    @staticmethod
+    def readLog(filename):
+        """Read a step log written by a script, returning a list of tuples (step, group, elapsed, exit code)."""
+        result = []
+        with open(filename, "r") as f:
+            f.readline()
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) == 5:
+                    result.append((parts[0], parts[1], float(parts[3]) - float(parts[2]), int(parts[4])))
+        return result
+
 # Simulate case / typecase
 
 def case(datum, choices):
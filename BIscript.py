@@ -1,8 +1,61 @@
 ### Utilities used by all bioscript programs
 
 import sys
+import time
+import atexit
 import os.path
-from BIutils.BImisc import get_iterator, decodeUnits, parseFraction
+import threading
+from BIutils.BImisc import get_iterator, decodeUnits, parseFraction, printWithUnits
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+### Sampling profiler
+
+class StackSampler(object):
+    """Sample the stack of the thread that created this object every `interval' seconds,
+and write the counts in collapsed-stack format (one line per stack: frames separated by
+semicolons, followed by the number of samples), suitable for flamegraph.pl or speedscope."""
+    interval = 0.005
+    counts = {}
+    nsamples = 0
+    _thread = None
+    _ident = None
+    _stop = None
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self._ident = threading.get_ident()
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._ident)
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+                self.nsamples += 1
+
+    def write(self, filename):
+        with open(filename, "w") as out:
+            for (stack, n) in sorted(self.counts.items()):
+                out.write("{} {}\n".format(stack, n))
 
 ### Class to define subcommands in program
 
@@ -23,6 +76,11 @@ class Script():
     errorCode = 1
     _commands = {}
     _commandNames = []
+    _profiler = None            # cProfile.Profile, if --profile was specified
+    _profileFile = None
+    _sampler = None             # StackSampler, if --sample was specified
+    _sampleFile = None
+    _startTime = None           # Wall-clock time at which --resources was processed
 
     def __init__(self, name, version="1.0", usage=None, errors=[]):
         """Errors should be a list of tuples: (code, name, message)."""
@@ -80,7 +138,10 @@ and the following one (if any). Otherwise, returns None."""
         return None
 
     def standardOpts(self, args):
-        """Process the standard arguments. If any of them are found, this function does not return."""
+        """Process the standard arguments. If any of them are found, this function does not return.
+The options --profile FILE, --sample FILE and --resources are removed from `args' and
+enable profiling or resource reporting (see profilingOpts)."""
+        self.profilingOpts(args)
         harg = self.getOptionValue(args, ['-h', '--help', '-E', '-v', '--version'])
         if harg:
             opt = harg[0]
@@ -104,6 +165,81 @@ and the following one (if any). Otherwise, returns None."""
                         sys.stderr.write("Unknown error code {}\n".format(errcode))
                 sys.exit(0)
 
+    def profilingOpts(self, args):
+        """Remove the profiling options from `args' and act on them:
+  --profile FILE   Run the program under cProfile, writing stats to FILE (readable with pstats)
+                   and the top functions by cumulative time to standard error at exit.
+  --sample FILE    Sample the program's stack every 5ms, writing collapsed stacks to FILE at exit.
+  --resources      Print wall time, CPU time, peak RSS and I/O to standard error at exit.
+"""
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a in ["--profile", "--sample"] and i + 1 < len(args):
+                filename = args[i+1]
+                del args[i:i+2]
+                if a == "--profile":
+                    import cProfile
+                    self._profileFile = filename
+                    self._profiler = cProfile.Profile()
+                    atexit.register(self._stopProfile)
+                    self._profiler.enable()
+                else:
+                    self._sampleFile = filename
+                    self._sampler = StackSampler()
+                    atexit.register(self._stopSampler)
+                    self._sampler.start()
+            elif a == "--resources":
+                del args[i]
+                self._startTime = time.time()
+                atexit.register(self.reportResources)
+            else:
+                i += 1
+
+    def _stopProfile(self):
+        import pstats
+        self._profiler.disable()
+        self._profiler.dump_stats(self._profileFile)
+        sys.stderr.write("Profile written to {}.\n".format(self._profileFile))
+        pstats.Stats(self._profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+
+    def _stopSampler(self):
+        self._sampler.stop()
+        self._sampler.write(self._sampleFile)
+        sys.stderr.write("{} stack samples written to {}.\n".format(self._sampler.nsamples, self._sampleFile))
+
+    def resourceUsage(self):
+        """Returns a dictionary with the wall time, CPU time (user and system, including
+child processes), peak RSS (in bytes) and bytes read and written by this program."""
+        result = {"wall": time.time() - (self._startTime or time.time())}
+        if resource:
+            me = resource.getrusage(resource.RUSAGE_SELF)
+            ch = resource.getrusage(resource.RUSAGE_CHILDREN)
+            rssunit = 1 if sys.platform == "darwin" else 1024
+            result["user"] = me.ru_utime + ch.ru_utime
+            result["sys"] = me.ru_stime + ch.ru_stime
+            result["maxrss"] = me.ru_maxrss * rssunit
+            result["childrss"] = ch.ru_maxrss * rssunit
+            result["read"] = me.ru_inblock * 512
+            result["written"] = me.ru_oublock * 512
+        if os.path.isfile("/proc/self/io"):
+            with open("/proc/self/io") as f:
+                io = dict([ line.split(":") for line in f if ":" in line ])
+            result["read"] = int(io["rchar"])
+            result["written"] = int(io["wchar"])
+        return result
+
+    def reportResources(self, out=sys.stderr):
+        """Write the resources used by this program to `out'."""
+        r = self.resourceUsage()
+        out.write("{}: wall {:.2f}s".format(self.name, r["wall"]))
+        if "user" in r:
+            out.write(", CPU {:.2f}s (user {:.2f}s, sys {:.2f}s), peak RSS {} (children {})".format(
+                r["user"] + r["sys"], r["user"], r["sys"], printWithUnits(r["maxrss"]), printWithUnits(r["childrss"])))
+        if "read" in r:
+            out.write(", read {}, written {}".format(printWithUnits(r["read"]), printWithUnits(r["written"])))
+        out.write("\n")
+
     def errmsg(self, code, *args):
         if code in self.errorMsg:
             if len(args) > 0:
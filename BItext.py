@@ -7,24 +7,52 @@ __license__   = "MIT"
 __date__      = "Mar 19 2019"
 __version__   = "1.0"
 
+import re
 import sys
+import builtins
+import functools
+import unicodedata
 
+# Matches CSI sequences (colors, cursor motion, erase) and two-character escapes
+_ESCAPES = re.compile(r"\x1b(?:\[[0-?]*[ -/]*[@-~]|[@-Z\\-_])")
+
+def strip(string):
+    """Returns `string' with all ANSI escape sequences removed."""
+    return _ESCAPES.sub("", string)
+
+def _charWidth(c):
+    """Returns the number of terminal columns occupied by character `c'."""
+    if unicodedata.combining(c):
+        return 0
+    if unicodedata.east_asian_width(c) in "WF":
+        return 2
+    return 1
+
+@functools.lru_cache(maxsize=8192)
 def len(string):
-    """Returns the length of `string' excluding ASCII control sequences.
+    """Returns the number of terminal columns occupied by `string', excluding ANSI escape
+sequences and counting East-Asian wide characters as two columns. Results are cached.
 Example: BItext.len(BItext.red("hello")) => 5.
 """
-    l = 0
-    skip = False
-    for c in string:
-        if skip:
-            if c == 'm':
-                skip = False
-        else:
-            if c == '\x1b':
-                skip = True
+    if "\x1b" in string:
+        string = _ESCAPES.sub("", string)
+    if string.isascii():
+        return builtins.len(string)
+    return sum([ _charWidth(c) for c in string ])
+
+def columnWidths(rows):
+    """Returns a list containing the maximum visible width of each column in `rows', a list of lists
+of cells (non-string cells are converted with str()). Rows may have different numbers of cells."""
+    widths = []
+    for row in rows:
+        for i, cell in enumerate(row):
+            w = len(cell if isinstance(cell, str) else str(cell))
+            if i < builtins.len(widths):
+                if w > widths[i]:
+                    widths[i] = w
             else:
-                l += 1
-    return l
+                widths.append(w)
+    return widths
 
 def _color(string, cidx, bold):
     """Add ascii control codes to `string' to print it in color `cidx', with bold indicator `bold'. Note: This adds 11 characters to `string'."""
@@ -125,7 +153,7 @@ class Matcher(object):
         self.string = string
         f = _functions[self.color]
         self.func = f[1] if bold else f[0]
-        self.slen = len(string)
+        self.slen = builtins.len(string)
         self.idx = 0
         self._status = NOMATCH
 
@@ -196,3 +224,67 @@ class MultiMatcher(object):
                     sys.stdout.write(ch)
                 except BrokenPipeError:
                     sys.exit(0)
+
+class Highlighter(object):
+    """Display a set of strings in color in a text stream. Unlike MultiMatcher, all strings
+are compiled into a single regular expression (longest strings first, so that the leftmost-longest
+match wins), and input is processed and written out in large blocks."""
+    regex = None
+    colored = {}
+    maxlen = 0
+
+    def __init__(self, pairs):
+        """`pairs' is a list of (string, color) tuples, where color is a color name optionally
+preceded by + for bold. If a string appears more than once, the first color is used."""
+        self.colored = {}
+        for (string, color) in pairs:
+            if string and string not in self.colored:
+                if color[0] == "+":
+                    func = _functions[color[1:]][1]
+                else:
+                    func = _functions[color][0]
+                self.colored[string] = func(string)
+        strings = sorted(self.colored.keys(), key=builtins.len, reverse=True)
+        self.maxlen = builtins.len(strings[0]) if strings else 0
+        self.regex = re.compile("|".join([ re.escape(s) for s in strings ])) if strings else None
+
+    def _highlight(self, text, final=True):
+        """Returns a tuple (output, rest): `output' is `text' with all matches colored, and
+`rest' is the tail of `text' that could still be the start of a match (only if `final' is False)."""
+        if self.regex is None:
+            return (text, "")
+        limit = builtins.len(text) if final else builtins.len(text) - self.maxlen + 1
+        pieces = []
+        pos = 0
+        for m in self.regex.finditer(text):
+            if m.start() >= limit:
+                break
+            pieces.append(text[pos:m.start()])
+            pieces.append(self.colored[m.group(0)])
+            pos = m.end()
+        if final:
+            pieces.append(text[pos:])
+            return ("".join(pieces), "")
+        cut = max(pos, limit)
+        pieces.append(text[pos:cut])
+        return ("".join(pieces), text[cut:])
+
+    def highlight(self, text):
+        """Returns `text' with all matching strings colored."""
+        return self._highlight(text)[0]
+
+    def run(self, instream=sys.stdin, outstream=sys.stdout, blocksize=1048576):
+        """Copy `instream' to `outstream' highlighting matching strings, reading and writing
+`blocksize' characters at a time."""
+        rest = ""
+        try:
+            while True:
+                block = instream.read(blocksize)
+                if not block:
+                    break
+                (out, rest) = self._highlight(rest + block, final=False)
+                outstream.write(out)
+            outstream.write(self.highlight(rest))
+            outstream.flush()
+        except BrokenPipeError:
+            sys.exit(0)
@@ -3,13 +3,53 @@
 # (c) 2016, A. Riva, DiBiG, ICBR Bioinformatics
 # University of Florida
 
+import os
 import sys
 import csv
-import numpy as np
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.style
-import matplotlib.pyplot as plt
+import json
+import math
+import hashlib
+import warnings
+import time
+import shlex
+import importlib
+import itertools
+import multiprocessing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+### Deferred imports: numpy and matplotlib are only loaded when first used, so that
+### listing plot types, printing help and reporting argument errors stay fast.
+
+class LazyModule(object):
+    """Placeholder for a module stored in global variable `varname'. The module is imported
+the first time one of its attributes is accessed, and then replaces the placeholder."""
+
+    def __init__(self, varname, modname, setup=None):
+        self._varname = varname
+        self._modname = modname
+        self._setup = setup
+
+    def __getattr__(self, attr):
+        if self._setup:
+            self._setup()
+        mod = importlib.import_module(self._modname)
+        globals()[self._varname] = mod
+        return getattr(mod, attr)
+
+def setupMatplotlib():
+    mpl = importlib.import_module("matplotlib")
+    mpl.use("Agg")
+    importlib.import_module("matplotlib.style")
+    importlib.import_module("matplotlib.colors")
+    globals()["matplotlib"] = mpl
+
+np = LazyModule("np", "numpy")
+matplotlib = LazyModule("matplotlib", "matplotlib", setup=setupMatplotlib)
+plt = LazyModule("plt", "matplotlib.pyplot", setup=setupMatplotlib)
 
 ### Easy plotting
 
@@ -28,6 +68,7 @@ class Plot():
     vsize = 8
     xcolumn = 0
     ycolumn = 1
+    pcolumn = None              # Column containing P-values, if any
     grid = None
     color = 'k'
     skipHeader = False
@@ -36,7 +77,17 @@ class Plot():
     colors = ['g', 'r', 'c', 'm', 'y', 'k']
     coloridx = 0
     nplots = 1                  # number of side-by-side plots (single row for now)
+    raster = False              # If True, draw background points as a density image
+    rasterBins = 500            # Number of bins on each axis of the density image
+    nplotted = 0                # Point counts, for plots that classify points
+    nover = 0
+    nunder = 0
+    nsig = 0
+    nfilt = 0
     plotly = False
+    cachefile = None            # Render cache manifest (see RenderCache)
+    forceRender = False         # If True, render even if the cache says the output is up to date
+    hashInputs = False          # If True, identify input files by content hash instead of size and mtime
 
     def __init__(self, **attributes):
         for a in self.attrNames:
@@ -86,6 +137,9 @@ class Plot():
             elif prev == "-yc":
                 self.ycolumn = int(a) - 1
                 prev = ""
+            elif prev == "-pc":
+                self.pcolumn = int(a) - 1
+                prev = ""
             elif prev == "-xr":
                 parts = a.split(":")
                 self.xlimits = [float(parts[0]), float(parts[1])]
@@ -94,12 +148,25 @@ class Plot():
                 parts = a.split(":")
                 self.ylimits = [float(parts[0]), float(parts[1])]
                 prev = ""
-            elif a in ["-o", "-t", "-g", "-c", "-xl", "-yl", "-xs", "-ys", "-xc", "-yc", "-xr", "-yr"]:
+            elif prev == "-rb":
+                self.raster = True
+                self.rasterBins = int(a)
+                prev = ""
+            elif prev == "-C":
+                self.cachefile = a
+                prev = ""
+            elif a in ["-o", "-t", "-g", "-c", "-xl", "-yl", "-xs", "-ys", "-xc", "-yc", "-pc", "-xr", "-yr", "-rb", "-C"]:
                 prev = a
             elif a == "-H":
-                self.skipheader = True
+                self.skipHeader = True
             elif a == "-P":
                 self.plotly = True
+            elif a == "-R":
+                self.raster = True
+            elif a in ["-F", "--force"]:
+                self.forceRender = True
+            elif a == "-CH":
+                self.hashInputs = True
             else:
                 restargs.append(a)
         return restargs
@@ -125,33 +192,98 @@ class Plot():
  -ys S   | Image height in inches (default: {})
  -xc C   | Column containing X values in data file (default: {})
  -yc C   | Column containing Y values in data file (default: {})
+ -pc C   | Column containing P-values in data file (default: none)
+ -H      | Skip header line in data file
  -xr A:B | Set X axis range to A - B
  -yr A:B | Set Y axis range to A - B
+ -R      | Draw background points as a density image (for very large datasets)
+ -rb B   | Like -R, using B x B bins for the density image (default: {})
+ -C F    | Use render cache manifest F: skip rendering if the output is up to date
+ -CH     | Identify input files in the cache by content hash instead of size and mtime
+ -F      | Render even if the output is up to date (also --force)
 
-""".format(self.hsize, self.vsize, self.xcolumn+1, self.ycolumn+1))
+""".format(self.hsize, self.vsize, self.xcolumn+1, self.ycolumn+1, self.rasterBins))
         return False
 
     def parseDatafile(self):
-        """Generic method to read data from tab-delimited files. Passes
-line contents to storeLine(). Lines starting with # are ignored."""
+        """Generic method to read data from tab-delimited files. Lines starting with # are
+ignored, and the first remaining line is skipped if skipHeader is True. If storeLine() is
+not overridden, the columns returned by dataColumns() are loaded in bulk into a 2-D array;
+otherwise line contents are passed to storeLine()."""
         with open(self.datafile, "r") as f:
+            if self.skipHeader:
+                line = f.readline()
+                while line.startswith("#"):
+                    line = f.readline()
+            start = f.tell()
+            if type(self).storeLine is Plot.storeLine:
+                try:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore") # Empty files are fine
+                        self.data = np.loadtxt(f, dtype=float, delimiter='\t', comments='#',
+                                               usecols=self.dataColumns(), ndmin=2)
+                    return
+                except ValueError:
+                    # Not all numeric: fall back to storeLine() to get the usual error
+                    f.seek(start)
             c = csv.reader(f, delimiter='\t')
             for line in c:
-                if len(line) > 0 and line[0][0] == '#':
+                if len(line) == 0 or line[0].startswith('#'):
                     continue
                 self.storeLine(line)
 
+    def dataColumns(self):
+        """Returns the list of columns stored for each line: xcolumn, ycolumn, and pcolumn if set."""
+        cols = [self.xcolumn, self.ycolumn]
+        if self.pcolumn is not None:
+            cols.append(self.pcolumn)
+        return cols
+
     def storeLine(self, line):
         """Generic method to store data from a tab-delimited line. By default
-reads X value from xcolumn, Y value from ycolumn."""
-        self.data.append([float(line[self.xcolumn]), float(line[self.ycolumn])])
+reads X value from xcolumn, Y value from ycolumn, and P-value from pcolumn if set."""
+        self.data.append([ float(line[c]) for c in self.dataColumns() ])
 
     def run(self):
-        """Generic method to generate image. Calls parseDatafile() and plot()."""
+        """Generic method to generate image. Calls parseDatafile() and plot(). If a render
+cache is in use, does nothing when the output is up to date."""
+        if self.cachefile:
+            C = RenderCache(self.cachefile)
+            key = C.key(self)
+            if C.isFresh(self, key):
+                sys.stderr.write("{} is up to date.\n".format(self.filename))
+            else:
+                start = time.time()
+                self.parseDatafile()
+                self.prepare()
+                self.plot()
+                C.store(self, key, time.time() - start)
+            C.save()
+            C.report()
+            return
         self.parseDatafile()
         self.prepare()
         self.plot()
 
+    def cacheKey(self):
+        """Returns a key identifying the data read by parseDatafile(), or None if the data
+depends on plot-specific options (i.e., if parseDatafile() or storeLine() are overridden)."""
+        if type(self).parseDatafile is Plot.parseDatafile and type(self).storeLine is Plot.storeLine:
+            return (self.datafile, tuple(self.dataColumns()), self.skipHeader)
+        return None
+
+    def loadData(self, cache):
+        """Like parseDatafile(), but reuse data already parsed by another plot if it is found in
+dictionary `cache'. Cached data is shared and should not be modified by plots."""
+        key = self.cacheKey()
+        if key and key in cache:
+            self.data = cache[key]
+            return True
+        self.parseDatafile()
+        if key:
+            cache[key] = self.data
+        return False
+
     def prepare(self):
         """Generic method to perform any initializations necessary after reading the data,
 and before calling plot().
@@ -182,6 +314,44 @@ and before calling plot().
             sys.stderr.write("Setting Y range to {}\n".format(self.ylimits))
             plt.ylim(self.ylimits)
 
+    def countPoints(self, sig, over, under):
+        """Store and report the number of points in each class for plots that classify points
+(see classifyPoints). Expects nfilt to be already set."""
+        self.nsig = int(np.count_nonzero(sig))
+        self.nover = int(np.count_nonzero(over))
+        self.nunder = int(np.count_nonzero(under))
+        self.nplotted = len(sig) - self.nfilt
+        sys.stderr.write("{} points plotted ({} over, {} under, {} significant), {} filtered.\n".format(
+            self.nplotted, self.nover, self.nunder, self.nsig, self.nfilt))
+
+    def points(self, ax, xs, ys, color, s=1, marker=None, background=False):
+        """Draw points (xs, ys) with ax.scatter. Background points (the ones not passing any
+threshold) are drawn as a density image instead if raster mode is on."""
+        if background and self.raster:
+            return self.density(ax, xs, ys)
+        return ax.scatter(xs, ys, color=color, s=s, marker=marker)
+
+    def density(self, ax, xs, ys, cmap="Greys"):
+        """Bin points (xs, ys) into a rasterBins x rasterBins grid and draw it with imshow,
+so drawing time and output size do not depend on the number of points."""
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        good = np.isfinite(xs) & np.isfinite(ys)
+        xs = xs[good]
+        ys = ys[good]
+        if len(xs) == 0:
+            return None
+        (counts, xedges, yedges) = np.histogram2d(xs, ys, bins=self.rasterBins,
+                                                  range=[[xs.min(), xs.max()], [ys.min(), ys.max()]])
+        counts = np.ma.masked_equal(counts.T, 0) # Leave empty bins transparent
+        # Start the colormap away from its (background-colored) low end, so that bins
+        # holding a single point remain visible
+        base = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+        colors = matplotlib.colors.ListedColormap(base(np.linspace(0.5, 1.0, 256)))
+        norm = matplotlib.colors.LogNorm(vmin=1, vmax=max(2, counts.max()))
+        return ax.imshow(counts, origin="lower", extent=[xedges[0], xedges[-1], yedges[0], yedges[-1]],
+                         aspect="auto", interpolation="nearest", cmap=colors, norm=norm)
+
     def plot(self, filename=None):
         if filename:
             self.filename = filename
@@ -202,17 +372,261 @@ and before calling plot().
             ax.grid(axis=self.grid)
         self.set_labels(ax)
         fig.savefig(self.filename)
+        plt.close(fig)
 
     def plot0(self, ax):
         #ax.scatter([v[0] for v in self.data], [v[1] for v in self.data])
         ax.plot([v[0] for v in self.data], [v[1] for v in self.data])
 
+### Streaming support for distribution plots
+
+def readColumnChunks(filename, column, skipHeader=False, chunksize=1000000):
+    """Generator returning the values in `column' of tab-delimited file `filename' as
+arrays of at most `chunksize' elements. Lines starting with # are ignored, and the first
+remaining line is skipped if `skipHeader' is True."""
+    with open(filename, "r") as f:
+        if skipHeader:
+            line = f.readline()
+            while line.startswith("#"):
+                line = f.readline()
+        while True:
+            chunk = list(itertools.islice(f, chunksize))
+            if not chunk:
+                return
+            lines = [ line for line in chunk if line.strip() and line[0] != '#' ]
+            if lines:
+                yield np.loadtxt(lines, dtype=float, delimiter='\t', usecols=[column], ndmin=1)
+
+def columnRange(filename, column, skipHeader=False):
+    """Returns the minimum and maximum of `column' in `filename', reading it in chunks."""
+    lo = None
+    hi = None
+    for chunk in readColumnChunks(filename, column, skipHeader=skipHeader):
+        if len(chunk):
+            lo = chunk.min() if lo is None else min(lo, chunk.min())
+            hi = chunk.max() if hi is None else max(hi, chunk.max())
+    return (lo, hi)
+
+class BinnedDistribution(object):
+    """Counts and sums of values falling in `nbins' equal bins between `lo' and `hi', accumulated
+one chunk at a time in bounded memory. Values outside [lo, hi] are ignored. Distributions
+with the same bins can be merged."""
+    edges = None
+    counts = None
+    sums = None
+
+    def __init__(self, lo, hi, nbins):
+        if hi <= lo:
+            hi = lo + 1.0
+        self.edges = np.linspace(lo, hi, nbins + 1)
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self.sums = np.zeros(nbins)
+
+    def add(self, values):
+        nbins = len(self.counts)
+        (lo, hi) = (self.edges[0], self.edges[-1])
+        values = values[(values >= lo) & (values <= hi)]
+        idx = ((values - lo) * (nbins / (hi - lo))).astype(np.int64)
+        np.minimum(idx, nbins - 1, out=idx) # hi goes in the last bin, as in np.histogram
+        self.counts += np.bincount(idx, minlength=nbins)
+        self.sums += np.bincount(idx, weights=values, minlength=nbins)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.sums += other.sums
+
+    @staticmethod
+    def fromFile(filename, column, nbins, limits=None, skipHeader=False):
+        """Build a BinnedDistribution from `column' of `filename'. If `limits' is not
+supplied, an additional pass over the file is made to find the range of the values."""
+        if limits:
+            (lo, hi) = limits
+        else:
+            (lo, hi) = columnRange(filename, column, skipHeader=skipHeader)
+            if lo is None:
+                (lo, hi) = (0.0, 1.0)
+        B = BinnedDistribution(lo, hi, nbins)
+        for chunk in readColumnChunks(filename, column, skipHeader=skipHeader):
+            B.add(chunk)
+        return B
+
+class QuantileSketch(object):
+    """Mergeable approximate quantile sketch, built as a hierarchy of compactors (as in the KLL
+sketch) each holding at most `k' items; an item at level h stands for 2**h values. Values can
+be added one at a time with add() or in arrays with update(), and the sketch uses O(k log(n/k))
+memory. The rank error of quantile() is roughly log2(n/k)/k of n: larger values of `k' are more
+accurate but slower."""
+    k = 200
+    n = 0
+    levels = []                 # levels[h] contains items of weight 2**h
+    vmin = None
+    vmax = None
+    _buffer = []
+    _rng = None
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._buffer = []
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, x):
+        self._buffer.append(x)
+        if len(self._buffer) >= self.k:
+            self._flush()
+
+    def update(self, values):
+        self._flush()
+        self._insert(np.asarray(values, dtype=float).ravel())
+
+    def _flush(self):
+        if self._buffer:
+            values = np.array(self._buffer, dtype=float)
+            self._buffer = []
+            self._insert(values)
+
+    def _insert(self, values):
+        if len(values) == 0:
+            return
+        self.n += len(values)
+        lo = values.min()
+        hi = values.max()
+        self.vmin = lo if self.vmin is None else min(self.vmin, lo)
+        self.vmax = hi if self.vmax is None else max(self.vmax, hi)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.k:
+                items = np.sort(self.levels[h])
+                nkeep = len(items) % 2      # An odd item out stays at this level
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], items[nkeep + self._rng.integers(2)::2]])
+                self.levels[h] = items[:nkeep]
+            h += 1
+
+    def merge(self, other):
+        """Add all values in sketch `other' to this one."""
+        self._flush()
+        other._flush()
+        if other.n == 0:
+            return
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h in range(len(other.levels)):
+            self.levels[h] = np.concatenate([self.levels[h], other.levels[h]])
+        self.n += other.n
+        self.vmin = other.vmin if self.vmin is None else min(self.vmin, other.vmin)
+        self.vmax = other.vmax if self.vmax is None else max(self.vmax, other.vmax)
+        self._compress()
+
+    def _cdf(self):
+        self._flush()
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([ np.full(len(l), 2.0**h) for (h, l) in enumerate(self.levels) ])
+        order = np.argsort(items, kind="stable")
+        return (items[order], np.cumsum(weights[order]))
+
+    def quantile(self, q):
+        """Returns the approximate `q' quantile (0 <= q <= 1) of the values seen so far."""
+        if q <= 0:
+            return self.vmin
+        if q >= 1:
+            return self.vmax
+        (items, cw) = self._cdf()
+        idx = np.searchsorted(cw, q * cw[-1])
+        return items[min(idx, len(items) - 1)]
+
+    def rank(self, x):
+        """Returns the approximate fraction of values seen so far that are not above `x'."""
+        (items, cw) = self._cdf()
+        idx = np.searchsorted(items, x, side="right")
+        return cw[idx - 1] / cw[-1] if idx > 0 else 0.0
+
+def summarizeSeries(spec):
+    """Reduce column `column' of tab-delimited file `filename' to the statistics needed to
+draw a box plot or a violin plot, reading it in chunks. `spec' is a tuple (filename, column,
+skipHeader, percentile, k, nbins, logscale). If `logscale' is True, zeros are dropped and the
+log10 of the remaining values is used. Values above the `percentile'th percentile (if specified)
+are ignored, quartiles are computed with a QuantileSketch of accuracy `k', and the density is
+a Gaussian KDE (with Scott's bandwidth, as in matplotlib) computed on `nbins' bins. Returns
+a dictionary in the format used by ax.bxp and ax.violin. Runs in worker processes, so only
+this summary is sent back to the parent."""
+    (filename, column, skipHeader, pct, k, nbins, logscale) = spec
+
+    def chunks():
+        for chunk in readColumnChunks(filename, column, skipHeader=skipHeader):
+            if logscale:
+                chunk = np.log10(chunk[chunk != 0])
+            yield chunk
+
+    S = QuantileSketch(k)
+    for chunk in chunks():
+        S.update(chunk)
+    if S.n == 0:
+        raise ValueError("no data in column {} of {}".format(column + 1, filename))
+    top = 1.0
+    hi = S.vmax
+    if pct:
+        hi = S.quantile(pct / 100.0)
+        top = S.rank(hi)
+    lo = S.vmin
+    (q1, med, q3) = [ S.quantile(q * top) for q in [0.25, 0.5, 0.75] ]
+    iqr = q3 - q1
+
+    # Second pass: fine histogram for mean, standard deviation and KDE
+    B = BinnedDistribution(lo, hi, nbins)
+    for chunk in chunks():
+        B.add(chunk)
+    n = B.counts.sum()
+    mean = B.sums.sum() / n
+    centers = 0.5 * (B.edges[:-1] + B.edges[1:])
+    std = np.sqrt(np.sum(B.counts * (centers - mean)**2) / n)
+    binwidth = B.edges[1] - B.edges[0]
+    sigma = max(std * n**(-0.2) / binwidth, 1e-3) # Kernel width, in bins
+    half = int(min(4 * sigma, nbins))
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) / sigma)**2)
+    kernel /= kernel.sum()
+    vals = np.convolve(B.counts, kernel, mode="same") / (n * binwidth)
+    return {"n": int(n), "mean": mean, "median": med, "med": med, "q1": q1, "q3": q3,
+            "min": lo, "max": hi, "coords": centers, "vals": vals, "fliers": [],
+            "whislo": max(lo, q1 - 1.5 * iqr), "whishi": min(hi, q3 + 1.5 * iqr)}
+
+def summarizeAll(specs, nprocs):
+    """Call summarizeSeries() on all `specs', using a pool of `nprocs' processes."""
+    if nprocs > 1 and len(specs) > 1:
+        with multiprocessing.Pool(min(nprocs, len(specs))) as pool:
+            return pool.map(summarizeSeries, specs, chunksize=1)
+    return [ summarizeSeries(sp) for sp in specs ]
+
+def parseColumns(a):
+    """Parse a comma-separated list of 1-based column numbers, returning 0-based indexes."""
+    return [ int(c) - 1 for c in a.split(",") ]
+
 class Histogram(Plot):
     "Histogram on a single data series."
     nbins = 10
     rwidth = None
+    stream = False              # If True, compute histogram in bounded memory
     attrNames = ["nbins"]
 
+    def usage(self):
+        sys.stdout.write("""Draw a histogram of the values in the X column of the input file.
+
+Plot-specific arguments:
+
+  -n N | Number of bins (default: {})
+  -r R | Relative width of the bars
+  -s   | Streaming mode: read the input in chunks, without storing all values.
+         Bins span the X range (-xr) if specified, otherwise the range of the data.
+
+""".format(self.nbins))
+        self.standardHelp()
+
     def parseArgs(self, args):
         prev = ""
         for a in args:
@@ -224,17 +638,29 @@ class Histogram(Plot):
                 prev = ""
             elif a  in ["-n", "-r"]:
                 prev = a
+            elif a == "-s":
+                self.stream = True
             else:
                 self.datafile = a
         return self.datafile
 
+    def parseDatafile(self):
+        if self.stream:
+            self.data = BinnedDistribution.fromFile(self.datafile, self.xcolumn, self.nbins,
+                                                    limits=self.xlimits, skipHeader=self.skipHeader)
+        else:
+            Plot.parseDatafile(self)
+
     def storeLine(self, line):
         """Generic method to store data from a tab-delimited line. By default
 reads X value from xcolumn, Y value from ycolumn."""
         self.data.append(float(line[self.xcolumn]))
 
     def plot0(self, ax):
-        ax.hist(self.data, bins=self.nbins, rwidth=self.rwidth)
+        if self.stream:
+            ax.hist(self.data.edges[:-1], bins=self.data.edges, weights=self.data.counts, rwidth=self.rwidth)
+        else:
+            ax.hist(self.data, bins=self.nbins, rwidth=self.rwidth)
 
 class BarChart(Plot):
     "Bar chart on one or more data series."
@@ -276,6 +702,7 @@ to a series, and has the same number of elements as the length of `xticklabels'.
         ax.legend([r[0] for r in rects], self.series)
 
 class PercentageBars(BarChart):
+    "Stacked bar chart of percentages."
     xticklabels = None
     attrNames = ['data', 'series', 'title', 'xlabel', 'ylabel', 'xticklabels']
 
@@ -301,7 +728,42 @@ class PercentageBars(BarChart):
         plt.xlabel("Sample")
         plt.legend(bars, self.series)
 
+def classifyPoints(data, maxv, fc=None, pval=None, absolute=False):
+    """Classify the rows of `data' (Y value, X value and optionally P-value) for Scatterplot and
+FoldChangePlot, working on whole columns at once. Returns a tuple (ys, xs, sig, over, under, other, nfilt)
+where sig, over, under and other are boolean masks over the rows. Rows with a value above `maxv'
+(in absolute value if `absolute' is True) are not in any mask, and are counted in nfilt."""
+    data = np.asarray(data, dtype=float)
+    if data.ndim != 2 or data.shape[0] == 0:
+        data = data.reshape((0, 2))
+    ys = data[:,0]
+    xs = data[:,1]
+    if absolute:
+        filt = (np.abs(ys) > maxv) | (np.abs(xs) > maxv)
+    else:
+        filt = (ys > maxv) | (xs > maxv)
+    rest = ~filt
+    if pval and data.shape[1] > 2:
+        sig = rest & (data[:,2] <= pval)
+        rest &= ~sig
+    else:
+        sig = np.zeros(len(ys), dtype=bool)
+    under = rest & (ys == 0)
+    rest &= ~under
+    over = rest & (xs == 0)
+    rest &= ~over
+    if fc:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lfc = np.log2(ys / xs)
+        up = rest & (lfc > fc)
+        down = rest & (lfc < -fc)
+        over |= up
+        under |= down
+        rest &= ~(up | down)
+    return (ys, xs, sig, over, under, rest, int(np.count_nonzero(filt)))
+
 class Scatterplot(Plot):
+    "Scatterplot of two data series, highlighting fold changes."
     fc = None                   # Fold change threshold
     pval = None                 # P-value threshold (default: don't check p-values)
     correlation = None          # Correlation (computed)
@@ -334,136 +796,50 @@ class Scatterplot(Plot):
             else:
                 self.datafile = a
 
+        if self.pval is not None and self.pcolumn is None:
+            sys.stderr.write("ERROR: -p requires the column containing P-values (-pc).\n")
+            return False
         if self.datafile:
             return True
 
     def plot0(self, ax):
-        xover = []
-        yover = []
-        xunder = []
-        yunder = []
-        xother = []
-        yother = []
-        xsig = []
-        ysig = []
-        nplotted = 0
-        nover    = 0
-        nunder   = 0
-        nfilt    = 0
-        nnn      = 0
-
-        v1 = np.array([d[0] for d in self.data])
-        v2 = np.array([d[1] for d in self.data])
-        # v3 = np.array([d[2] for d in self.data])
+        data = np.asarray(self.data, dtype=float)
+        v1 = data[:,0]
+        v2 = data[:,1]
         self.correlation = np.corrcoef(v1, v2)
         if self.truncate:
             m1 = np.percentile(v1, 90.0)
             m2 = np.percentile(v2, 90.0)
             self.maxv = max(m1, m2)
-        for row in self.data:
-            #print (row, row[2], self.pval, row[2] <= self.pval)
-            if row[0] > self.maxv or row[1] > self.maxv:
-                nfilt += 1
-                continue
-            if self.pval and (row[2] <= self.pval):
-                ysig.append(row[0])
-                xsig.append(row[1])
-            elif row[0] == 0:
-                yunder.append(row[0])
-                xunder.append(row[1])
-                nunder += 1
-            elif row[1] == 0:
-                yover.append(row[0])
-                xover.append(row[1])
-                nover += 1
-            elif self.fc:
-                fc = np.log2(1.0 * row[0] / row[1])
-                if fc > self.fc:
-                    yover.append(row[0])
-                    xover.append(row[1])
-                    nover += 1
-                elif fc < -self.fc:
-                    yunder.append(row[0])
-                    xunder.append(row[1])
-                    nunder += 1
-                else:
-                    yother.append(row[0])
-                    xother.append(row[1])
-            else:
-                yother.append(row[0])
-                xother.append(row[1])
-            nplotted += 1
+        (ys, xs, sig, over, under, other, self.nfilt) = classifyPoints(data, self.maxv, fc=self.fc, pval=self.pval)
+        self.countPoints(sig, over, under)
 
         if self.truncate or self.limits:
             ax.set_autoscale_on(False)
-        ax.scatter(xother, yother, color='k', s=1)
-        ax.scatter(xover, yover, color='#FF8C00', s=1)
-        ax.scatter(xunder, yunder, color='#0000FF', s=1)
-        ax.scatter(xsig, ysig, color='#FF0000', s=1)
+        self.points(ax, xs[other], ys[other], 'k', background=True)
+        self.points(ax, xs[over], ys[over], '#FF8C00')
+        self.points(ax, xs[under], ys[under], '#0000FF')
+        self.points(ax, xs[sig], ys[sig], '#FF0000')
         if self.truncate:
             ax.axis([0, self.maxv, 0, self.maxv])
         elif self.limits:
             ax.axis(self.limits)
 
 class FoldChangePlot(Plot):
+    "Scatterplot of two series of fold changes."
     fc = None                   # Fold change threshold
     pval = None                 # P-value threshold (default: don't check p-values)
     correlation = None          # Correlation (computed)
     maxv = 5
 
     def plot0(self, ax):
-        xover = []
-        yover = []
-        xunder = []
-        yunder = []
-        xother = []
-        yother = []
-        xsig = []
-        ysig = []
-        nplotted = 0
-        nover    = 0
-        nunder   = 0
-        nfilt    = 0
-        nnn      = 0
+        (ys, xs, sig, over, under, other, self.nfilt) = classifyPoints(self.data, self.maxv, fc=self.fc, pval=self.pval, absolute=True)
+        self.countPoints(sig, over, under)
 
-        for row in self.data:
-            #print (row, row[2], self.pval, row[2] <= self.pval)
-            if abs(row[0]) > self.maxv or abs(row[1]) > self.maxv:
-                nfilt += 1
-                continue
-            if self.pval and (row[2] <= self.pval):
-                ysig.append(row[0])
-                xsig.append(row[1])
-            elif row[0] == 0:
-                yunder.append(row[0])
-                xunder.append(row[1])
-                nunder += 1
-            elif row[1] == 0:
-                yover.append(row[0])
-                xover.append(row[1])
-                nover += 1
-            elif self.fc:
-                fc = np.log2(1.0 * row[0] / row[1])
-                if fc > self.fc:
-                    yover.append(row[0])
-                    xover.append(row[1])
-                    nover += 1
-                elif fc < -self.fc:
-                    yunder.append(row[0])
-                    xunder.append(row[1])
-                    nunder += 1
-                else:
-                    yother.append(row[0])
-                    xother.append(row[1])
-            else:
-                yother.append(row[0])
-                xother.append(row[1])
-            nplotted += 1
-
-        ax.scatter(xother, yother, color='k', s=1)
-        ax.scatter(xover, yover, color='#FF8C00', s=1)
-        ax.scatter(xunder, yunder, color='#0000FF', s=1)
-        ax.scatter(xsig, ysig, color='#FF0000', s=1)
+        self.points(ax, xs[other], ys[other], 'k', background=True)
+        self.points(ax, xs[over], ys[over], '#FF8C00')
+        self.points(ax, xs[under], ys[under], '#0000FF')
+        self.points(ax, xs[sig], ys[sig], '#FF0000')
         ax.set_autoscale_on(False)
         ax.axis([0, self.maxv, 0, self.maxv])
 
@@ -497,7 +873,7 @@ Plot-specific arguments:
                 self.fc = float(a)
                 prev = ""
             elif prev == "-p":
-                self.pval = -np.log10(float(a))
+                self.pval = -math.log10(float(a))
                 prev = ""
             elif a in ["-f", "-p"]:
                 prev = a
@@ -510,85 +886,69 @@ Plot-specific arguments:
         return True
     
     def plot0(self, ax):
-        xover = []
-        yover = []
-        xunder = []
-        yunder = []
-        xother = []
-        yother = []
-
         # data is a list of pairs [fc, pval]
-        for row in self.data:
-            fc = row[0]
-            lp = -np.log10(row[1])
-            if lp > self.pval:  # P-value over threshold?
-                if fc > self.fc:
-                    xover.append(fc)
-                    yover.append(lp)
-                    self.nup += 1
-                elif fc < -self.fc:
-                    xunder.append(fc)
-                    yunder.append(lp)
-                    self.ndown += 1
-                elif self.plot_all:
-                    xother.append(fc)
-                    yother.append(lp)
-            elif self.plot_all:
-                xother.append(fc)
-                yother.append(lp)
-        ax.scatter(xother, yother, color='k', s=1)
-        ax.scatter(xover, yover, color='#FF0000', s=2, marker='o')
-        ax.scatter(xunder, yunder, color='#00FF00', s=2, marker='o')
+        data = np.asarray(self.data, dtype=float).reshape((-1, len(self.dataColumns())))
+        fc = data[:,0]
+        with np.errstate(divide="ignore"):
+            lp = -np.log10(data[:,1])
+        sig = lp > self.pval    # P-value over threshold?
+        over = sig & (fc > self.fc)
+        under = sig & (fc < -self.fc)
+        self.nup = int(np.count_nonzero(over))
+        self.ndown = int(np.count_nonzero(under))
+        sys.stderr.write("{} up, {} down.\n".format(self.nup, self.ndown))
+        if self.plot_all:
+            other = ~(over | under)
+            self.points(ax, fc[other], lp[other], 'k', background=True)
+        self.points(ax, fc[over], lp[over], '#FF0000', s=2, marker='o')
+        self.points(ax, fc[under], lp[under], '#00FF00', s=2, marker='o')
         ax.axhline(self.pval, 0.0, 1.0, color='#0000FF', linestyle=':')
         ax.axvline(-self.fc, 0.0, 1.0, color='#0000FF', linestyle=':')
         ax.axvline(self.fc, 0.0, 1.0, color='#0000FF', linestyle=':')
         # ax.axis([-5.0, 5.0, 0, 10.0])
 
 class MAplot(Plot):
+    "MA plot: average log2 expression on X axis, log2(FC) on Y axis."
     fc = 1                      # Fold change threshold
     pval = None
     correlation = None          # Correlation (computed)
     maxx = 20
     maxy = 0
+    nup = 0                     # Number of points with M above fc (computed)
+    ndown = 0                   # Number of points with M below -fc (computed)
 
     def plot(self, filename=None):
-        xs = []
-        ys = []
-        xsig = []
-        ysig = []
-        nplotted = 0
-
         if filename:
             self.filename = filename
-        for row in self.data:
-            if row[0] == 0 or row[1] == 0:
-                continue
-            m = np.log2(1.0 * row[0] / row[1])
-            a = 0.5 * (np.log2(float(row[0])) + np.log2(float(row[1])))
-            if a > self.maxx:
-                continue
-            if abs(m) > self.maxy:
-                self.maxy = abs(m)
-            if self.pval:
-                if row[2] <= self.pval:
-                    xsig.append(a)
-                    ysig.append(b)
-                else:
-                    xs.append(a)
-                    ys.append(m)
-            else:
-                xs.append(a)
-                ys.append(m)
-            nplotted += 1
+        data = np.asarray(self.data, dtype=float).reshape((-1, len(self.dataColumns())))
+        r0 = data[:,0]
+        r1 = data[:,1]
+        good = (r0 != 0) & (r1 != 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            m = np.log2(r0 / r1)
+            a = 0.5 * (np.log2(r0) + np.log2(r1))
+        good &= ~(a > self.maxx)
+        self.maxy = max(self.maxy, np.nanmax(np.abs(m[good]), initial=0.0))
+        if self.pval and data.shape[1] > 2:
+            sig = good & (data[:,2] <= self.pval)
+            good &= ~sig
+        else:
+            sig = np.zeros(len(m), dtype=bool)
+        self.nup = int(np.count_nonzero((good | sig) & (m > self.fc)))
+        self.ndown = int(np.count_nonzero((good | sig) & (m < -self.fc)))
+        sys.stderr.write("{} up, {} down.\n".format(self.nup, self.ndown))
 
         fig, ax = plt.subplots(figsize=(self.hsize, self.vsize))
         ax.set_autoscale_on(False)
-        ax.scatter(xs, ys, color=self.color, s=1)
+        self.points(ax, a[good], m[good], self.color, background=True)
+        self.points(ax, a[sig], m[sig], '#FF0000')
         ax.axis([0, self.maxx, -self.maxy, self.maxy])
         self.set_labels(ax)
-        fig.savefig(filename)
+        fig.savefig(self.filename)
+        plt.close(fig)
 
 class HockeyStickPlot(Plot):
+    "Hockey stick plot: values sorted in increasing order."
     logscale = False
     normalize = False
      
@@ -615,105 +975,270 @@ class HockeyStickPlot(Plot):
         
     def plot0(self, ax):
         self.data.sort()
-        ax.scatter(range(len(self.data)), self.data, color=self.color, s=1)
+        self.points(ax, np.arange(len(self.data)), self.data, self.color, background=True)
 
 class BoxPlot(Plot):
+    "Box plots of two or more data series."
     logscale = False
     percentile = None
+    sketchK = None              # If set, summarize data with QuantileSketches of this accuracy
+    sketches = None
+    columns = [1, 2]            # Columns containing the data series
+    labels = None
+    nprocs = None               # If set, summarize each series in a pool of nprocs processes
+    nbins = 512
 
     def init(self):
-        self.data = [ [], [] ]
+        self.data = []
+        self.datafile = []
+
+    def usage(self):
+        sys.stdout.write("""Draw box plots of the values in columns 2 and 3 (or the ones specified with -cols) of the input file(s).
+
+Plot-specific arguments:
+
+  -p P    | Only keep rows in which all values are not above the P-th percentile
+  -l      | Use log10 of values
+  -q K    | Do not store values, compute the plots from quantile sketches with accuracy K
+            (e.g. 200; larger is more accurate but slower). Outliers are not shown.
+  -cols C | Comma-separated list of columns to plot (default: 2,3)
+  -labels L | Comma-separated list of labels for the data series
+  -j N    | Read each series (column of each file) separately in N parallel processes,
+            using quantile sketches (see -q, default accuracy 1000). Always used with
+            multiple input files. Percentile clipping applies to each series separately,
+            and with -l zeros are dropped from each series separately.
+
+""")
+        self.standardHelp()
 
     def parseArgs(self, args):
-        self.nplots = 2
         prev = ""
         for a in args:
             if prev == "-p":
                 self.percentile = int(a)
                 prev = ""
-            elif a in ["-p"]:
+            elif prev == "-q":
+                self.sketchK = int(a)
+                prev = ""
+            elif prev == "-cols":
+                self.columns = parseColumns(a)
+                prev = ""
+            elif prev == "-labels":
+                self.labels = a.split(",")
+                prev = ""
+            elif prev == "-j":
+                self.nprocs = int(a)
+                prev = ""
+            elif a in ["-p", "-q", "-cols", "-labels", "-j"]:
                 prev = a
             elif a == "-l":
                 self.logscale = True
             else:
-                self.datafile = a
-        self.data2 = []
+                self.datafile.append(a)
+        if not self.datafile:
+            return False
+        if len(self.datafile) > 1:
+            self.nprocs = self.nprocs or 1
+        if not self.labels:
+            if len(self.datafile) == 1 and self.columns == [1, 2]:
+                self.labels = ["MUT", "WT"]
+            else:
+                self.labels = [ "{}:{}".format(f, c + 1) for f in self.datafile for c in self.columns ]
+        self.nplots = len(self.datafile) * len(self.columns)
+        if self.nprocs:
+            return True
+        self.datafile = self.datafile[0]
+        self.data = [ [] for c in self.columns ]
+        if self.sketchK:
+            self.sketches = [ QuantileSketch(self.sketchK) for c in self.columns ]
         return True
 
+    def parseDatafile(self):
+        if self.nprocs:
+            specs = [ (f, c, self.skipHeader, self.percentile, self.sketchK or 1000, self.nbins, self.logscale)
+                      for f in self.datafile for c in self.columns ]
+            self.data = summarizeAll(specs, self.nprocs)
+        else:
+            Plot.parseDatafile(self)
+
     def storeLine(self, line):
-        good = True
-        a = float(line[1])
-        b = float(line[2])
+        values = [ float(line[c]) for c in self.columns ]
         if self.logscale:
-            if a == 0:
-                good = False
-            else:
-                a = np.log10(a)
-            if b == 0:
-                good = False
-            else:
-                b = np.log10(b)
-        if good:
-            self.data[0].append(a)
-            self.data[1].append(b)
+            if 0 in values:
+                return
+            values = [ math.log10(v) for v in values ]
+        if self.sketches:
+            for (S, v) in zip(self.sketches, values):
+                S.add(v)
+        else:
+            for (d, v) in zip(self.data, values):
+                d.append(v)
 
     def clip(self, limit):
-        d1 = []
-        d2 = []
-        for i in range(len(self.data)):
-            a = self.data[0][i]
-            b = self.data[1][i]
-            if a <= limit and b <= limit:
-                d1.append(a)
-                d2.append(b)
-        return d1, d2
+        """Returns the data series keeping only rows in which all values are not above `limit'."""
+        data = [ np.asarray(d) for d in self.data ]
+        good = np.ones(len(data[0]), dtype=bool)
+        for d in data:
+            good &= (d <= limit)
+        return [ d[good] for d in data ]
+
+    def sketchStats(self, S, limit=None):
+        """Returns box plot statistics (in the format used by ax.bxp) for the values summarized by
+sketch `S' that are not above `limit'. Whiskers extend to 1.5 times the interquartile range,
+or to the extreme values."""
+        top = S.rank(limit) if limit is not None else 1.0
+        (q1, med, q3) = [ S.quantile(q * top) for q in [0.25, 0.5, 0.75] ]
+        iqr = q3 - q1
+        return {"med": med, "q1": q1, "q3": q3, "fliers": [],
+                "whislo": max(S.quantile(0.0), q1 - 1.5 * iqr),
+                "whishi": min(S.quantile(top), q3 + 1.5 * iqr)}
 
     def plot0(self, ax):
-        if self.percentile:
-            limit = min(np.percentile(self.data, self.percentile), np.percentile(self.data2, self.percentile))
-            self.data, self.data2 = self.clip(limit)
+        ax = np.atleast_1d(ax)
+        if self.nprocs:
+            # Data already summarized by summarizeSeries()
+            for (bp, st, label) in zip(ax, self.data, self.labels):
+                bp.bxp([st])
+                bp.set_title(label)
+            return
+
+        if self.sketches:
+            # Note: with sketches, clipping is applied to each series separately.
+            limit = None
+            if self.percentile:
+                limit = min([ S.quantile(self.percentile / 100.0) for S in self.sketches ])
+            for (bp, S, label) in zip(ax, self.sketches, self.labels):
+                bp.bxp([self.sketchStats(S, limit)])
+                bp.set_title(label)
+            return
 
-        (bp1, bp2) = ax
-        bp1.boxplot(self.data)
-        bp1.set_title("MUT")
-        bp2.boxplot(self.data2)
-        bp2.set_title("WT")
+        data = [ np.asarray(d) for d in self.data ]
+        if self.percentile:
+            limit = min([ np.percentile(d, self.percentile) for d in data ])
+            data = self.clip(limit)
+        for (bp, d, label) in zip(ax, data, self.labels):
+            bp.boxplot(d)
+            bp.set_title(label)
 
 class ViolinPlot(Plot):
+    "Violin plots of one series from each input file."
     nfiles = 0
+    columns = None              # Columns to plot from each file (default: ycolumn)
+    nprocs = None               # Number of parallel processes (default: one per CPU)
+    exact = False               # If True, load all values and use matplotlib's KDE
+    percentile = None
+    sketchK = 1000
+    nbins = 512
 
     def init(self):
         self.data = []
 
+    def usage(self):
+        sys.stdout.write("""Draw violin plots of the values in the Y column (or the ones specified with -cols) of each input file.
+
+Plot-specific arguments:
+
+  -cols C | Comma-separated list of columns to plot from each file (default: Y column)
+  -j N    | Read files using N parallel processes (default: number of CPUs)
+  -p P    | Ignore values above the P-th percentile of each series
+  -q K    | Accuracy of the quantile sketches used for medians (default: {})
+  -e      | Exact mode: load all values in memory and use matplotlib's KDE
+
+""".format(self.sketchK))
+        self.standardHelp()
+
     def parseArgs(self, args):
-        self.datafile = args
+        self.datafile = []
+        prev = ""
+        for a in args:
+            if prev == "-cols":
+                self.columns = parseColumns(a)
+                prev = ""
+            elif prev == "-j":
+                self.nprocs = int(a)
+                prev = ""
+            elif prev == "-p":
+                self.percentile = float(a)
+                prev = ""
+            elif prev == "-q":
+                self.sketchK = int(a)
+                prev = ""
+            elif a in ["-cols", "-j", "-p", "-q"]:
+                prev = a
+            elif a == "-e":
+                self.exact = True
+            else:
+                self.datafile.append(a)
         self.nfiles = len(self.datafile)
-        #print self.datafile
-        return True
-    
+        if not self.columns:
+            self.columns = [self.ycolumn]
+        return self.nfiles > 0
+
     def parseDatafile(self):
-        self.data = [ [] for _ in range(self.nfiles) ]
-        for idx in range(self.nfiles):
-            with open(self.datafile[idx], "r") as f:
-                c = csv.reader(f, delimiter='\t')
-                for line in c:
-                    if len(line) > 0 and line[0][0] == '#':
-                        continue
-                    self.data[idx].append(float(line[self.ycolumn]))
+        if not self.exact:
+            specs = [ (f, c, self.skipHeader, self.percentile, self.sketchK, self.nbins, False)
+                      for f in self.datafile for c in self.columns ]
+            self.data = summarizeAll(specs, self.nprocs or multiprocessing.cpu_count())
+            return
+        self.data = []
+        for f in self.datafile:
+            for c in self.columns:
+                d = np.concatenate([[]] + list(readColumnChunks(f, c, skipHeader=self.skipHeader)))
+                if self.percentile:
+                    d = d[d <= np.percentile(d, self.percentile)]
+                self.data.append(d)
 
     def plot0(self, ax):
-        ax.violinplot(self.data, vert=True, showmeans=True, showmedians=True)
+        if self.exact:
+            ax.violinplot(self.data, vert=True, showmeans=True, showmedians=True)
+        else:
+            ax.violin(self.data, showmeans=True, showmedians=True)
         ax.grid()
 
 class KSPlot(Plot):
     """Kolmogorov-Smirnoff plot (cumulative sum plot)."""
+    stream = False              # If True, compute the curve from binned sums in bounded memory
+    nbins = 10000
 
     def init(self):
         self.data = []
         self.ycolumn = 0
 
+    def usage(self):
+        sys.stdout.write("""Draw the cumulative sum of the sorted values in the input file, as a fraction of the total,
+against the fraction of values.
+
+Plot-specific arguments:
+
+  -s   | Streaming mode: read the input in chunks, approximating the curve with binned sums.
+  -n N | Number of bins in streaming mode (default: {})
+
+""".format(self.nbins))
+        self.standardHelp()
+
+    def parseArgs(self, args):
+        prev = ""
+        for a in args:
+            if prev == "-n":
+                self.nbins = int(a)
+                prev = ""
+            elif a in ["-n"]:
+                prev = a
+            elif a == "-s":
+                self.stream = True
+            else:
+                self.datafile = a
+        return self.datafile
+
+    def parseDatafile(self):
+        if self.stream:
+            self.data = BinnedDistribution.fromFile(self.datafile, self.ycolumn, self.nbins, skipHeader=self.skipHeader)
+        else:
+            Plot.parseDatafile(self)
+
     def prepare(self):
-        self.data.sort()
+        if not self.stream:
+            self.data.sort()
         self.xlimits = [0.0, 1.0]
         self.ylimits = [0.0, 1.0]
 
@@ -721,19 +1246,14 @@ class KSPlot(Plot):
         self.data.append(float(line[self.ycolumn]))
 
     def plot0(self, ax):
-        step = 1/len(self.data)
-        xv = step
-        yv = self.data[0]
-        xs = [xv]
-        ys = [yv]
-        for d in self.data[1:]:
-            xv += step
-            yv += d
-            xs.append(xv)
-            ys.append(yv)
-
-        ys = [ y/yv for y in ys ]
-        ax.plot(xs, ys)
+        if self.stream:
+            # One point at the end of each bin: values within a bin are treated as equal
+            xs = np.concatenate([[0.0], np.cumsum(self.data.counts)])
+            ys = np.concatenate([[0.0], np.cumsum(self.data.sums)])
+        else:
+            xs = np.arange(1, len(self.data) + 1, dtype=float)
+            ys = np.cumsum(self.data)
+        ax.plot(xs / xs[-1], ys / ys[-1])
 
 CLASSES = {'plot': Plot,
            'bars': BarChart,
@@ -757,14 +1277,238 @@ def listPlotTypes():
     sys.stdout.write(fmt.format("Name", "Description"))
     sys.stdout.write(bar)
     for k in labels:
-        desc = CLASSES[k]().__doc__
+        desc = CLASSES[k].__doc__
         sys.stdout.write(fmt.format(k, desc))
     sys.stdout.write("\n")
 
+### Render cache
+
+class RenderCache(object):
+    """Manifest of rendered images, stored as a JSON file. Each output file is recorded with a
+key hashing the plot class, the plot options and the identity of the input files (path, size
+and mtime, or content hash); an output is up to date if it still exists unchanged and the key
+has not changed. The manifest also keeps cumulative hit/miss statistics. Several processes
+can share a manifest: save() merges this session's changes into the current manifest while
+holding a lock on FILENAME.lock."""
+    filename = ""
+    entries = {}
+    stats = {}
+    hits = 0                    # For this session
+    misses = 0
+    saved = 0.0                 # Rendering time saved by hits
+    changed = {}                # Entries stored in this session
+    _skip = ["data", "sketches", "datafile", "cachefile", "forceRender", "hashInputs"]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = {}
+        (self.entries, self.stats) = self.read()
+
+    def read(self):
+        """Returns the entries and statistics currently stored in the manifest file."""
+        stats = {"hits": 0, "misses": 0, "saved": 0.0}
+        if not os.path.isfile(self.filename):
+            return ({}, stats)
+        with open(self.filename, "r") as f:
+            m = json.load(f)
+        stats.update(m.get("stats", {}))
+        return (m.get("entries", {}), stats)
+
+    def fileIdentity(self, path, hashContent=False):
+        st = os.stat(path)
+        if hashContent:
+            h = hashlib.sha1()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1048576), b""):
+                    h.update(block)
+            return [path, st.st_size, h.hexdigest()]
+        return [path, st.st_size, st.st_mtime]
+
+    def key(self, P):
+        """Returns the cache key for plot `P' (after its arguments have been parsed)."""
+        opts = {}
+        for a in dir(P):
+            if a.startswith("_") or a in self._skip:
+                continue
+            v = getattr(P, a)
+            if v is None or isinstance(v, (str, int, float, bool, list, tuple, dict)):
+                opts[a] = v
+        inputs = P.datafile if isinstance(P.datafile, list) else [P.datafile]
+        desc = {"class": P.__class__.__name__,
+                "code": self.fileIdentity(__file__),
+                "options": opts,
+                "inputs": [ self.fileIdentity(f, P.hashInputs) for f in inputs ]}
+        return hashlib.sha1(json.dumps(desc, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def isFresh(self, P, key):
+        """Returns True if the output of plot `P' is up to date according to `key', updating statistics."""
+        e = self.entries.get(P.filename)
+        fresh = (not P.forceRender and e is not None and e["key"] == key and
+                 os.path.isfile(P.filename) and os.path.getmtime(P.filename) == e["mtime"])
+        if fresh:
+            self.hits += 1
+            self.saved += e["time"]
+        else:
+            self.misses += 1
+        return fresh
+
+    def store(self, P, key, elapsed):
+        e = {"key": key, "mtime": os.path.getmtime(P.filename), "time": elapsed}
+        self.entries[P.filename] = e
+        self.changed[P.filename] = e
+
+    def save(self):
+        """Merge the entries and statistics of this session into the manifest file."""
+        with open(self.filename + ".lock", "w") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            (self.entries, self.stats) = self.read()
+            self.entries.update(self.changed)
+            self.stats["hits"] += self.hits
+            self.stats["misses"] += self.misses
+            self.stats["saved"] += self.saved
+            tmpfile = "{}.{}.tmp".format(self.filename, os.getpid())
+            with open(tmpfile, "w") as out:
+                json.dump({"entries": self.entries, "stats": self.stats}, out, indent=1)
+            os.rename(tmpfile, self.filename)
+        self.changed = {}
+        self.hits = self.misses = 0
+        self.saved = 0.0
+
+    def report(self, out=sys.stderr):
+        """Write cumulative cache statistics to `out'."""
+        total = self.stats["hits"] + self.stats["misses"]
+        out.write("Render cache {}: {} entries, {} hits / {} lookups ({:.1f}%), {:.1f}s saved.\n".format(
+            self.filename, len(self.entries), self.stats["hits"], total,
+            100.0 * self.stats["hits"] / total if total else 0.0, self.stats["saved"]))
+
+### Batch mode
+
+def readManifest(filename):
+    """Read a batch manifest. This is either a JSON file containing a list of objects with keys
+`type', `data', `output' and (optionally) `options', or a tab-delimited file with the same four
+columns. Data files and options may be lists or space-separated strings. Returns a list of jobs,
+each of which is a tuple (idx, plottype, datafiles, output, options)."""
+    jobs = []
+    with open(filename, "r") as f:
+        if filename.endswith(".json"):
+            entries = json.load(f)
+        else:
+            entries = []
+            for line in csv.reader(f, delimiter='\t'):
+                if len(line) == 0 or line[0].startswith('#'):
+                    continue
+                entries.append(dict(zip(["type", "data", "output", "options"], line)))
+    for e in entries:
+        data = e["data"]
+        opts = e.get("options", [])
+        jobs.append((len(jobs) + 1, e["type"],
+                     shlex.split(data) if isinstance(data, str) else data,
+                     e["output"],
+                     shlex.split(opts) if isinstance(opts, str) else opts))
+    return jobs
+
+def makeJobPlot(job):
+    """Returns the plot object for batch job `job', with its arguments parsed."""
+    (idx, cmd, datafiles, output, opts) = job
+    if cmd not in CLASSES:
+        raise ValueError("unknown plot type `{}'".format(cmd))
+    P = CLASSES[cmd]()
+    specargs = P.standardArgs(opts + ["-o", output] + datafiles)
+    if not specargs or not P.parseArgs(specargs):
+        raise ValueError("bad arguments")
+    return P
+
+def runJobs(jobs):
+    """Run a list of batch jobs in the current process, parsing each data file only once.
+Returns a list of tuples (idx, elapsed), where elapsed is None if the job failed."""
+    cache = {}
+    results = []
+    for (idx, cmd, datafiles, output, opts) in jobs:
+        try:
+            start = time.time()
+            P = makeJobPlot((idx, cmd, datafiles, output, opts))
+            cached = P.loadData(cache)
+            parsed = time.time()
+            P.prepare()
+            P.plot()
+            end = time.time()
+            sys.stderr.write("[job {}] {} {}: data {:.3f}s{}, plot {:.3f}s\n".format(
+                idx, cmd, output, parsed - start, " (cached)" if cached else "", end - parsed))
+            results.append((idx, end - start))
+        except Exception as e:
+            results.append((idx, None))
+            sys.stderr.write("[job {}] {} {}: ERROR: {}\n".format(idx, cmd, output, e))
+    return results
+
+def runBatch(manifest, nprocs=1, cachefile=None, force=False):
+    """Render all plots listed in `manifest' from a single process, or from a pool of `nprocs'
+processes. Jobs reading the same data files are always assigned to the same process. If
+`cachefile' is specified, jobs whose output is up to date in that render cache are skipped
+(unless `force' is True)."""
+    jobs = readManifest(manifest)
+    start = time.time()
+    C = None
+    keys = {}
+    plots = {}
+    if cachefile:
+        C = RenderCache(cachefile)
+        todo = []
+        for j in jobs:
+            try:
+                P = makeJobPlot(j)
+            except Exception:
+                todo.append(j)      # Let runJobs report the error
+                continue
+            P.forceRender = P.forceRender or force
+            keys[j[0]] = C.key(P)
+            plots[j[0]] = P
+            if C.isFresh(P, keys[j[0]]):
+                sys.stderr.write("[job {}] {} {}: up to date\n".format(j[0], j[1], j[3]))
+            else:
+                todo.append(j)
+    else:
+        todo = jobs
+    groups = {}
+    for j in todo:
+        groups.setdefault(tuple(j[2]), []).append(j)
+    if nprocs > 1 and len(groups) > 1:
+        with multiprocessing.Pool(min(nprocs, len(groups))) as pool:
+            results = sum(pool.map(runJobs, groups.values(), chunksize=1), [])
+    else:
+        results = runJobs(todo)
+    nfailed = 0
+    for (idx, elapsed) in results:
+        if elapsed is None:
+            nfailed += 1
+        elif C and idx in keys:
+            C.store(plots[idx], keys[idx], elapsed)
+    sys.stderr.write("{} jobs, {} rendered, {} failed, {:.3f}s.\n".format(len(jobs), len(todo), nfailed, time.time() - start))
+    if C:
+        C.save()
+        C.report()
+    return nfailed
+
 def main(args):
     if args:
         if "-L" in args:
             return listPlotTypes()
+        if args[0] == "-B" and len(args) > 1:
+            nprocs = 1
+            cachefile = None
+            prev = ""
+            for a in args[2:]:
+                if prev == "-j":
+                    nprocs = int(a)
+                    prev = ""
+                elif prev == "-C":
+                    cachefile = a
+                    prev = ""
+                elif a in ["-j", "-C"]:
+                    prev = a
+            nfailed = runBatch(args[1], nprocs=nprocs, cachefile=cachefile, force=("-F" in args or "--force" in args))
+            return 1 if nfailed else 0
         cmd = args[0]
         if cmd in CLASSES:
             P = CLASSES[cmd]()
@@ -774,9 +1518,11 @@ def main(args):
                     P.run()
                 else:
                     P.usage()
+                    return 1
         else:
             sys.stdout.write("ERROR: the first argument, `{}' should be a plot name.\n\n".format(cmd))
             sys.stdout.write("Valid plot names: {}\n".format(", ".join(CLASSES.keys())))
+            return 1
     else:
         usage()
 
@@ -784,13 +1530,20 @@ def usage():
     sys.stdout.write("""Plots - simple command-line plotter.
 
 Usage: Plots.py plot-type [general options] [plot-specific options]
+       Plots.py -B manifest [-j N] [-C cache] [-F]
 
 Call `Plots.py -L' to display available plot types.
 
+Call `Plots.py -B manifest' to render all plots listed in the manifest from a single
+process (or N processes with -j). The manifest is a JSON file (.json) containing a list of
+objects with keys type, data, output and options, or a tab-delimited file with the same
+four columns. With -C, plots whose output is up to date in render cache manifest `cache'
+are skipped (-F or --force renders them anyway). The exit status is 1 if any plot failed.
+
 Call `Plots.py plot-type -h' to see plot-specific options.
 
 """)
     Plot().standardHelp()
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Benchmark the vectorized point classification used by Scatterplot and FoldChangePlot
+(Plots.classifyPoints) against the original row-by-row loop.
+
+Usage: classify.py [npoints]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Plots
+
+def loopClassify(data, maxv, fc=None, pval=None):
+    """The original Scatterplot.plot0 loop, returning the point lists and counters."""
+    xover = []
+    yover = []
+    xunder = []
+    yunder = []
+    xother = []
+    yother = []
+    xsig = []
+    ysig = []
+    nover    = 0
+    nunder   = 0
+    nfilt    = 0
+    for row in data:
+        if row[0] > maxv or row[1] > maxv:
+            nfilt += 1
+            continue
+        if pval and (row[2] <= pval):
+            ysig.append(row[0])
+            xsig.append(row[1])
+        elif row[0] == 0:
+            yunder.append(row[0])
+            xunder.append(row[1])
+            nunder += 1
+        elif row[1] == 0:
+            yover.append(row[0])
+            xover.append(row[1])
+            nover += 1
+        elif fc:
+            lfc = np.log2(1.0 * row[0] / row[1])
+            if lfc > fc:
+                yover.append(row[0])
+                xover.append(row[1])
+                nover += 1
+            elif lfc < -fc:
+                yunder.append(row[0])
+                xunder.append(row[1])
+                nunder += 1
+            else:
+                yother.append(row[0])
+                xother.append(row[1])
+        else:
+            yother.append(row[0])
+            xother.append(row[1])
+    return (xsig, xover, xunder, xother, nover, nunder, nfilt)
+
+def makeData(n, seed=1):
+    rng = np.random.default_rng(seed)
+    data = np.empty((n, 3))
+    data[:,0] = np.floor(rng.exponential(100.0, n))
+    data[:,1] = np.floor(rng.exponential(100.0, n))
+    data[:,2] = rng.uniform(0.0, 1.0, n)
+    return data
+
+def main(n):
+    data = makeData(n)
+    rows = data.tolist()
+    maxv = np.percentile(data[:,:2], 90.0)
+
+    start = time.time()
+    (xsig, xover, xunder, xother, nover, nunder, nfilt) = loopClassify(rows, maxv, fc=1.0, pval=0.01)
+    tloop = time.time() - start
+
+    start = time.time()
+    (ys, xs, sig, over, under, other, vfilt) = Plots.classifyPoints(data, maxv, fc=1.0, pval=0.01)
+    tvec = time.time() - start
+
+    same = (nfilt == vfilt and nover == np.count_nonzero(over) and nunder == np.count_nonzero(under) and
+            np.array_equal(xsig, xs[sig]) and np.array_equal(xover, xs[over]) and
+            np.array_equal(xunder, xs[under]) and np.array_equal(xother, xs[other]))
+    sys.stdout.write("{} points: loop {:.3f}s, vectorized {:.3f}s ({:.1f}x), results {}.\n".format(
+        n, tloop, tvec, tloop / tvec, "identical" if same else "DIFFERENT"))
+    return same
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if not main(n):
+        sys.exit(1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""Guard against regressions in the startup time of the Plots command line. Checks that
+importing Plots, `Plots.py -L' and `Plots.py plot-type -h' do not load numpy or matplotlib,
+and reports their running time. Exits with a non-zero status if a heavy module was loaded,
+or if a command took longer than the limit (in seconds, default 0.5).
+
+Usage: startup.py [limit]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+HEAVY = ["numpy", "matplotlib"]
+
+CHECK = """
+import sys
+sys.path.insert(0, {root!r})
+sys.argv = ["Plots.py"] + {args!r}
+import Plots
+if sys.argv[1:]:
+    Plots.main(sys.argv[1:])
+sys.stderr.write(",".join([ m for m in {heavy!r} if m in sys.modules ]))
+"""
+
+def timeCommand(args, nrep=5):
+    """Returns the best running time over `nrep' runs of Plots with `args', and the list of heavy modules loaded."""
+    code = CHECK.format(root=ROOT, args=args, heavy=HEAVY)
+    best = None
+    loaded = ""
+    for i in range(nrep):
+        start = time.time()
+        p = subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = time.time() - start
+        loaded = p.stderr.strip().split("\n")[-1]
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, loaded)
+
+def main(limit):
+    good = True
+    for args in [ [], ["-L"], ["volcano", "-h"], ["scatter"] ]:
+        (elapsed, loaded) = timeCommand(args)
+        status = "ok"
+        if loaded:
+            status = "FAIL (loaded {})".format(loaded)
+            good = False
+        elif elapsed > limit:
+            status = "FAIL (over {}s)".format(limit)
+            good = False
+        sys.stdout.write("{:20} {:.3f}s  {}\n".format(" ".join(["Plots.py"] + args), elapsed, status))
+    return good
+
+if __name__ == "__main__":
+    limit = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    if not main(limit):
+        sys.exit(1)